@@ -0,0 +1,65 @@
+"""normalized reference names
+
+Revision ID: 39252ab9da1b
+Revises: c537074ad792
+Create Date: 2026-10-18 14:27:05.562913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '39252ab9da1b'
+down_revision = 'c537074ad792'
+branch_labels = None
+depends_on = None
+
+
+def _normalize(name):
+    return " ".join(name.split()).casefold()
+
+
+def _merge_duplicates(conn, table, references):
+    """Fill normalized_name and point every reference to the oldest row of each duplicate group."""
+    canonical = {}
+    for rec_id, name in conn.execute(sa.text('SELECT id, name FROM {} ORDER BY id'.format(table))).fetchall():
+        key = _normalize(name)
+        if key in canonical:
+            for ref_table, ref_column, owner_column in references:
+                if owner_column:
+                    # drop links that would duplicate an existing link to the kept row
+                    conn.execute(sa.text(
+                        'DELETE FROM {t} WHERE {c} = :dup AND {o} IN (SELECT {o} FROM {t} WHERE {c} = :keep)'
+                        .format(t=ref_table, c=ref_column, o=owner_column)
+                    ), {"dup": rec_id, "keep": canonical[key]})
+                conn.execute(sa.text(
+                    'UPDATE {} SET {} = :keep WHERE {} = :dup'.format(ref_table, ref_column, ref_column)
+                ), {"dup": rec_id, "keep": canonical[key]})
+            conn.execute(sa.text('DELETE FROM {} WHERE id = :dup'.format(table)), {"dup": rec_id})
+        else:
+            canonical[key] = rec_id
+            conn.execute(
+                sa.text('UPDATE {} SET normalized_name = :key WHERE id = :id'.format(table)),
+                {"key": key, "id": rec_id},
+            )
+
+
+def upgrade():
+    conn = op.get_bind()
+    for table in ('cities', 'subjects'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column('normalized_name', sa.String(length=1024), nullable=True))
+    _merge_duplicates(conn, 'cities', [('events', 'city', None), ('user_filters', 'city', None)])
+    _merge_duplicates(conn, 'subjects', [('events_subjects', 'subject', 'event'), ('filters_subjects', 'subject', 'filter')])
+    for table in ('cities', 'subjects'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column('normalized_name', existing_type=sa.String(length=1024), nullable=False)
+        op.create_index('uq_{}_normalized_name'.format(table), table, ['normalized_name'], unique=True)
+
+
+def downgrade():
+    for table in ('subjects', 'cities'):
+        op.drop_index('uq_{}_normalized_name'.format(table), table_name=table)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('normalized_name')
@@ -0,0 +1,52 @@
+"""events full-text index
+
+Revision ID: 5d0e7a3c91f4
+Revises: 39252ab9da1b
+Create Date: 2026-10-18 17:12:48.204117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d0e7a3c91f4'
+down_revision = '39252ab9da1b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    # external content table: the index stores only tokens, names are read from events
+    op.execute(
+        "CREATE VIRTUAL TABLE events_fts USING fts5("
+        "name, content='events', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+    )
+    op.execute(
+        'CREATE TRIGGER events_fts_insert AFTER INSERT ON events BEGIN '
+        'INSERT INTO events_fts(rowid, name) VALUES (new.id, new.name); '
+        'END'
+    )
+    op.execute(
+        'CREATE TRIGGER events_fts_delete AFTER DELETE ON events BEGIN '
+        "INSERT INTO events_fts(events_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+        'END'
+    )
+    op.execute(
+        'CREATE TRIGGER events_fts_update AFTER UPDATE OF name ON events BEGIN '
+        "INSERT INTO events_fts(events_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+        'INSERT INTO events_fts(rowid, name) VALUES (new.id, new.name); '
+        'END'
+    )
+    op.execute("INSERT INTO events_fts(events_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TRIGGER events_fts_update')
+    op.execute('DROP TRIGGER events_fts_delete')
+    op.execute('DROP TRIGGER events_fts_insert')
+    op.execute('DROP TABLE events_fts')
@@ -0,0 +1,54 @@
+"""events time r*tree
+
+Revision ID: 8a4f2b6d1e37
+Revises: 5d0e7a3c91f4
+Create Date: 2026-10-18 19:40:12.918355
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4f2b6d1e37'
+down_revision = '5d0e7a3c91f4'
+branch_labels = None
+depends_on = None
+
+# epoch seconds of an event's start and end, a missing bound is unbounded
+START = "COALESCE(CAST(strftime('%s', {}.start_time) AS REAL), -1e12)"
+END = "COALESCE(CAST(strftime('%s', {}.end_time) AS REAL), 1e12)"
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('CREATE VIRTUAL TABLE events_rtree USING rtree(id, start_ts, end_ts)')
+    op.execute(
+        'CREATE TRIGGER events_rtree_insert AFTER INSERT ON events BEGIN '
+        'INSERT INTO events_rtree(id, start_ts, end_ts) VALUES (new.id, {}, {}); '
+        'END'.format(START.format('new'), END.format('new'))
+    )
+    op.execute(
+        'CREATE TRIGGER events_rtree_update AFTER UPDATE OF start_time, end_time ON events BEGIN '
+        'UPDATE events_rtree SET start_ts = {}, end_ts = {} WHERE id = new.id; '
+        'END'.format(START.format('new'), END.format('new'))
+    )
+    op.execute(
+        'CREATE TRIGGER events_rtree_delete AFTER DELETE ON events BEGIN '
+        'DELETE FROM events_rtree WHERE id = old.id; '
+        'END'
+    )
+    op.execute(
+        'INSERT INTO events_rtree(id, start_ts, end_ts) SELECT id, {}, {} FROM events'
+        .format(START.format('events'), END.format('events'))
+    )
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TRIGGER events_rtree_delete')
+    op.execute('DROP TRIGGER events_rtree_update')
+    op.execute('DROP TRIGGER events_rtree_insert')
+    op.execute('DROP TABLE events_rtree')
@@ -0,0 +1,35 @@
+"""change log
+
+Revision ID: b71c9e04d2a5
+Revises: 8a4f2b6d1e37
+Create Date: 2026-10-18 21:14:07.532871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b71c9e04d2a5'
+down_revision = '8a4f2b6d1e37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('change_log',
+    sa.Column('id', sa.INTEGER(), autoincrement=True, nullable=False),
+    sa.Column('kind', sa.String(length=32), nullable=False),
+    sa.Column('ref_id', sa.INTEGER(), nullable=True),
+    sa.Column('data', sa.Text(), nullable=True),
+    sa.Column('origin', sa.String(length=32), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sqlite_autoincrement=True
+    )
+    op.create_index('ix_change_log_created_at', 'change_log', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_change_log_created_at', table_name='change_log')
+    op.drop_table('change_log')
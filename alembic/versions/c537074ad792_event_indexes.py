@@ -0,0 +1,39 @@
+"""event indexes
+
+Revision ID: c537074ad792
+Revises: 2292e5fd227d
+Create Date: 2026-10-18 11:02:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c537074ad792'
+down_revision = '2292e5fd227d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_events_city_start_time', 'events', ['city', 'start_time'], unique=False)
+    op.create_index('ix_events_start_time_end_time', 'events', ['start_time', 'end_time'], unique=False)
+    # drop duplicate links before enforcing uniqueness, keeping the oldest one
+    op.execute(
+        'DELETE FROM events_subjects WHERE id NOT IN '
+        '(SELECT MIN(id) FROM events_subjects GROUP BY event, subject)'
+    )
+    op.create_index('uq_events_subjects_event_subject', 'events_subjects', ['event', 'subject'], unique=True)
+    op.create_index('ix_events_subjects_subject_event', 'events_subjects', ['subject', 'event'], unique=False)
+    op.create_index('ix_filters_subjects_filter_subject', 'filters_subjects', ['filter', 'subject'], unique=False)
+    op.create_index('ix_user_filters_user_id', 'user_filters', ['user_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_user_filters_user_id', table_name='user_filters')
+    op.drop_index('ix_filters_subjects_filter_subject', table_name='filters_subjects')
+    op.drop_index('ix_events_subjects_subject_event', table_name='events_subjects')
+    op.drop_index('uq_events_subjects_event_subject', table_name='events_subjects')
+    op.drop_index('ix_events_start_time_end_time', table_name='events')
+    op.drop_index('ix_events_city_start_time', table_name='events')
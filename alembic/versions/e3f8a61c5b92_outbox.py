@@ -0,0 +1,36 @@
+"""outbox
+
+Revision ID: e3f8a61c5b92
+Revises: b71c9e04d2a5
+Create Date: 2026-10-18 23:05:51.207614
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3f8a61c5b92'
+down_revision = 'b71c9e04d2a5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('outbox',
+    sa.Column('id', sa.INTEGER(), autoincrement=True, nullable=False),
+    sa.Column('kind', sa.String(length=64), nullable=False),
+    sa.Column('payload', sa.Text(), nullable=False),
+    sa.Column('attempts', sa.INTEGER(), nullable=False),
+    sa.Column('available_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('owner', sa.String(length=32), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_outbox_available_at', 'outbox', ['available_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_outbox_available_at', table_name='outbox')
+    op.drop_table('outbox')
@@ -1,29 +1,186 @@
 # coding: utf-8
 
 import jwt
+import hmac
+import asyncio
 import hashlib
 import datetime
 import json
 import base64
-import dateutil.parser
 
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 
 from fastapi import status
 
+from sqlalchemy import event, or_
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.future import select
-from sqlalchemy.orm.attributes import InstrumentedAttribute
+from sqlalchemy.orm import Session, object_session
 from sqlalchemy.sql.sqltypes import DateTime
 
-from settings import LOCAL_SALT, SERVER_SECRET
+from settings import LOCAL_SALT, SERVER_SECRET, PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL, PASSWORD_HASHER, \
+    PASSWORD_HASH_WORKERS, PASSWORD_HASH_CONCURRENCY, PBKDF2_ITERATIONS, SCRYPT_N, SCRYPT_R, SCRYPT_P
 from response_models import Error40xResponse
+from cache import TTLCache
+from references import reference_caches
+from change_feed import change_feed, change_row
 
 from models.session import get_session
-from models.models import Users
+from models.base import normalize_name
+from models.models import Users, EventSubject, ChangeLog
 
 
-def password_hash(password, salt):
-    return hashlib.sha512(password.encode("utf-8") + salt.encode("utf-8") + LOCAL_SALT.encode("utf-8")).hexdigest()
+class Sha512Hasher:
+    """Legacy scheme: stored hashes are untagged sha512 hex digests."""
+
+    scheme = "sha512"
+
+    def encode(self, password, salt):
+        return hashlib.sha512(password.encode("utf-8") + salt.encode("utf-8") + LOCAL_SALT.encode("utf-8")).hexdigest()
+
+    def verify(self, password, salt, encoded):
+        return hmac.compare_digest(self.encode(password, salt), encoded)
+
+    def must_update(self, encoded):
+        return False
+
+
+class Pbkdf2Hasher:
+    """``pbkdf2_sha256$<iterations>$<hex>``"""
+
+    scheme = "pbkdf2_sha256"
+
+    def __init__(self, iterations=PBKDF2_ITERATIONS):
+        self.iterations = iterations
+
+    def _hash(self, password, salt, iterations):
+        return hashlib.pbkdf2_hmac(
+            "sha256", password.encode("utf-8"), (salt + LOCAL_SALT).encode("utf-8"), iterations,
+        ).hex()
+
+    def encode(self, password, salt):
+        return "{}${}${}".format(self.scheme, self.iterations, self._hash(password, salt, self.iterations))
+
+    def verify(self, password, salt, encoded):
+        scheme, iterations, digest = encoded.split("$")
+        return hmac.compare_digest(self._hash(password, salt, int(iterations)), digest)
+
+    def must_update(self, encoded):
+        return int(encoded.split("$")[1]) != self.iterations
+
+
+class ScryptHasher:
+    """``scrypt$<n>$<r>$<p>$<hex>``"""
+
+    scheme = "scrypt"
+
+    def __init__(self, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+        self.n, self.r, self.p = n, r, p
+
+    def _hash(self, password, salt, n, r, p):
+        return hashlib.scrypt(
+            password.encode("utf-8"), salt=(salt + LOCAL_SALT).encode("utf-8"),
+            n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024,
+        ).hex()
+
+    def encode(self, password, salt):
+        return "{}${}${}${}${}".format(
+            self.scheme, self.n, self.r, self.p, self._hash(password, salt, self.n, self.r, self.p),
+        )
+
+    def verify(self, password, salt, encoded):
+        scheme, n, r, p, digest = encoded.split("$")
+        return hmac.compare_digest(self._hash(password, salt, int(n), int(r), int(p)), digest)
+
+    def must_update(self, encoded):
+        return encoded.split("$")[1:4] != [str(self.n), str(self.r), str(self.p)]
+
+
+PASSWORD_HASHERS = {h.scheme: h for h in (Sha512Hasher(), Pbkdf2Hasher(), ScryptHasher())}
+
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_hash_semaphore = None
+
+
+def _hasher_for(encoded):
+    return PASSWORD_HASHERS[encoded.split("$", 1)[0] if "$" in encoded else Sha512Hasher.scheme]
+
+
+async def _run_hash(func, *args):
+    """Run a hash function on the hashing pool, at most PASSWORD_HASH_CONCURRENCY at a time."""
+    global _hash_semaphore
+    if _hash_semaphore is None:
+        _hash_semaphore = asyncio.Semaphore(PASSWORD_HASH_CONCURRENCY)
+    async with _hash_semaphore:
+        return await asyncio.get_running_loop().run_in_executor(_hash_executor, func, *args)
+
+
+async def password_hash(password, salt, scheme=PASSWORD_HASHER):
+    """Hash ``password`` with ``scheme`` off the event loop."""
+    return await _run_hash(PASSWORD_HASHERS[scheme].encode, password, salt)
+
+
+async def check_password(password, salt, encoded):
+    """Return (password matches, stored hash should be replaced with the default scheme)."""
+    hasher = _hasher_for(encoded)
+    if not await _run_hash(hasher.verify, password, salt, encoded):
+        return False, False
+    return True, hasher.scheme != PASSWORD_HASHER or hasher.must_update(encoded)
+
+
+principal_cache = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+# bumped on every invalidation so a user read before a change is not cached after it
+_principal_cache_generation = 0
+
+
+def _principal_key(user_id, password):
+    return user_id, hashlib.sha1(password.encode("utf-8")).hexdigest()
+
+
+def invalidate_principal(user_id):
+    global _principal_cache_generation
+    _principal_cache_generation += 1
+    principal_cache.invalidate_tag(("user", user_id))
+
+
+@event.listens_for(Users, "after_insert")
+def _log_user_insert(mapper, connection, target):
+    connection.execute(ChangeLog.__table__.insert(), change_row("user", target.id))
+
+
+@event.listens_for(Users, "after_update")
+@event.listens_for(Users, "after_delete")
+def _track_user_change(mapper, connection, target):
+    connection.execute(ChangeLog.__table__.insert(), change_row("user", target.id))
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("changed_users", set()).add(target.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_users(session):
+    for user_id in session.info.pop("changed_users", ()):
+        invalidate_principal(user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_users(session):
+    session.info.pop("changed_users", None)
+
+
+async def _apply_user_changes(session, changes):
+    for user_id, data in changes:
+        invalidate_principal(user_id)
+
+
+async def _reset_principals(session):
+    global _principal_cache_generation
+    _principal_cache_generation += 1
+    principal_cache.clear()
+
+
+change_feed.subscribe("user", _apply_user_changes, _reset_principals)
 
 
 async def check_token(token):
@@ -33,10 +190,16 @@ async def check_token(token):
         # logger.error('check_token, Decode auth token failed: {}'.format(e))
         return status.HTTP_401_UNAUTHORIZED, 'wrong token type', None
     else:
-        user_info = None
-        async with get_session() as s:
-            user_info = await s.execute(select(Users).filter(Users.id == token_info['user_id']))
-            user_info = user_info.scalars().first()
+        key = _principal_key(token_info['user_id'], token_info['password'])
+        user_info = principal_cache.get(key)
+        if user_info is None:
+            generation = _principal_cache_generation
+            async with get_session() as s:
+                user_info = await s.execute(select(Users).filter(Users.id == token_info['user_id']))
+                user_info = user_info.scalars().first()
+            if user_info and user_info.password == token_info['password'] and \
+                    generation == _principal_cache_generation:
+                principal_cache.set(key, user_info, tags=[("user", user_info.id)])
         if user_info:
             if user_info.password == token_info['password'] and \
                     token_info['expiration_time'] >= datetime.datetime.now().timestamp():
@@ -46,6 +209,26 @@ async def check_token(token):
         else:
             return status.HTTP_401_UNAUTHORIZED, 'no user', None
 
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(json.dumps({"id": last_id}).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Return the last seen id stored in ``cursor``, 0 for an empty cursor.
+
+    Raises ValueError for anything that is not a cursor issued by ``encode_cursor``.
+    """
+    if not cursor:
+        return 0
+    try:
+        last_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))["id"]
+    except Exception as e:
+        raise ValueError("wrong cursor") from e
+    if not isinstance(last_id, int):
+        raise ValueError("wrong cursor")
+    return last_id
+
+
 def check_auth(func):
     @wraps(func)
     async def wrapper(**kwargs):
@@ -83,43 +266,210 @@ def accept_user_type(user_type):
     return decorator
 
 
+def parse_datetime(value):
+    """Strict ISO-8601 parser for request timestamps, ``Z`` is accepted for UTC.
+
+    Raises ValueError for anything else.
+    """
+    if value[-1:] in ("Z", "z"):
+        value = value[:-1] + "+00:00"
+    return datetime.datetime.fromisoformat(value)
+
+
+def _no_sentinel(value):
+    return None if value == -1 else value
+
+
+def _parse_no_sentinel(value):
+    # str fields carry the sentinel as "-1"
+    return None if value is None or value == -1 or value == "-1" else parse_datetime(value)
+
+
+class WritePlan:
+    """What ``create_update_record`` writes for a (model, request schema, fields) triple.
+
+    ``insert`` and ``update`` hold (column name, converter, nullable) tuples;
+    converters turn request values into column values, mapping the -1
+    sentinel to None and parsing DateTime columns. ``required`` names the
+    NOT NULL columns with no default that an insert must fill.
+    """
+
+    def __init__(self, db_model, request_fields, fields):
+        columns = db_model.__table__.columns
+        converter = {
+            c.name: _parse_no_sentinel if isinstance(c.type, DateTime) else _no_sentinel
+            for c in columns
+        }
+        self.insert = tuple(
+            (c.name, converter[c.name], c.nullable)
+            for c in columns
+            if c.name != "id" and c.name in request_fields
+        )
+        self.update = tuple((name, converter[name], columns[name].nullable) for name in fields if name != "id")
+        self.required = frozenset(
+            name for name, convert, nullable in self.insert
+            if not nullable and columns[name].default is None and columns[name].server_default is None
+        )
+        self.has_user = "user_id" in columns
+
+
+_write_plans = {}
+
+
+def write_plan(db_model, request_model, fields):
+    key = (db_model, type(request_model), tuple(fields))
+    plan = _write_plans.get(key)
+    if plan is None:
+        plan = _write_plans[key] = WritePlan(db_model, type(request_model).__fields__, fields)
+    return plan
+
+
+# returned by create_update_record for a row that belongs to another user
+NOT_OWNED = object()
+
+
+class RequiredField(ValueError):
+    """Raised by ``create_update_record`` when a NOT NULL column would be left empty or cleared."""
+
+    def __init__(self, field):
+        super().__init__("{} is required".format(field))
+        self.field = field
+
+
 async def create_update_record(session, db_model, fields, request_model, user, editable=False):
+    """Insert a row from ``request_model``, or with an ``id`` load that row and update ``fields`` if ``editable``.
+
+    Returns None for an unknown id and NOT_OWNED, without touching it, for
+    another user's row. An update leaves the fields that are None alone and
+    clears the ones set to -1. Raises RequiredField, before writing anything,
+    for a NOT NULL column that is missing on insert or cleared on update.
+    """
+    plan = write_plan(db_model, request_model, fields)
+    values = request_model.__dict__
     if request_model.id:
         r = (await session.execute(
             select(db_model)
             .filter(db_model.id == request_model.id)
-        ))
-        if editable:
-            if user and "user_id" in db_model.__dict__ and  r.user_id != user.id:
-                return r
-            for j in fields:
-                if isinstance(db_model.__dict__[j].__getattr__("type"), DateTime) and \
-                        request_model.__dict__[j] is not None:
-                    r.__setattr__(j, dateutil.parser.parse(request_model.__dict__[j]))
-                else:
-                    if request_model.__dict__[j] != -1:
-                        r.__setattr__(j, request_model.__dict__[j])
-                    else:
-                        r.__setattr__(j, None)
+        )).scalars().first()
+        if r is not None and user and plan.has_user and r.user_id != user.id:
+            return NOT_OWNED
+        if r is not None and editable:
+            changes = {}
+            for name, convert, nullable in plan.update:
+                value = values[name]
+                if value is None:
+                    continue
+                value = convert(value)
+                if value is None and not nullable:
+                    raise RequiredField(name)
+                changes[name] = value
+            for name, value in changes.items():
+                setattr(r, name, value)
             await session.flush()
 
     else:
         db_dict = {}
-        for i in db_model.__dict__:
-            if i != "id" and \
-                    isinstance(db_model.__dict__[i], InstrumentedAttribute) and \
-                    i in request_model.__dict__.keys() and \
-                    (db_model.__dict__[i].__getattr__("nullable") or request_model.__dict__[i] is not None):
-                if isinstance(db_model.__dict__[i].__getattr__("type"), DateTime):
-                    db_dict[i] = dateutil.parser.parse(request_model.__dict__[i]) \
-                        if request_model.__dict__[i] is not None and request_model.__dict__[i] != -1 else None
-                else:
-                    db_dict[i] = request_model.__dict__[i] \
-                        if request_model.__dict__[i] is not None and request_model.__dict__[i] != -1 else None
-        if "user_id" in db_model.__dict__.keys():
+        for name, convert, nullable in plan.insert:
+            value = values[name]
+            if value is not None:
+                value = convert(value)
+            if value is None and name in plan.required:
+                raise RequiredField(name)
+            if nullable or value is not None:
+                db_dict[name] = value
+        if plan.has_user:
             db_dict["user_id"] = user.id
         r = db_model(**db_dict)
         session.add(r)
         await session.flush()
 
     return r
+
+
+def insert_ignore(session, db_model):
+    """INSERT that skips rows conflicting with a unique index, for the session's dialect."""
+    insert = postgresql.insert if session.bind.dialect.name == "postgresql" else sqlite.insert
+    return insert(db_model)
+
+
+class References:
+    """Rows resolved by ``resolve_references``; ``get`` maps a request to (id, name).
+
+    ``loaded`` keeps the rows that came from the database, to be added to
+    the reference cache once the transaction has committed.
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_name = {}
+        self.loaded = []
+
+    def add(self, rec_id, name, normalized_name):
+        self.by_id[rec_id] = name
+        self.by_name[normalized_name] = (rec_id, name)
+
+    def get(self, request):
+        if request.id:
+            name = self.by_id.get(request.id)
+            return (request.id, name) if name is not None else None
+        if request.name:
+            return self.by_name.get(normalize_name(request.name))
+        return None
+
+
+async def resolve_references(session, db_model, requests):
+    """Resolve City/Subject requests from the reference cache, then by id or normalized name in one lookup.
+
+    Names that do not exist yet are inserted with a single multi-row upsert.
+    Requests with an unknown id resolve to None.
+    """
+    refs = References()
+    cache = reference_caches.get(db_model)
+    ids = set()
+    names = {}
+    for r in requests:
+        rec = cache.lookup(r) if cache is not None else None
+        if rec is not None:
+            refs.add(*rec)
+        elif r.id:
+            ids.add(r.id)
+        elif r.name:
+            names.setdefault(normalize_name(r.name), r.name)
+    conditions = []
+    if ids:
+        conditions.append(db_model.id.in_(ids))
+    if names:
+        conditions.append(db_model.normalized_name.in_(names))
+    if not conditions:
+        return refs
+    for row in (await session.execute(
+        select(db_model.id, db_model.name, db_model.normalized_name).filter(or_(*conditions))
+    )).fetchall():
+        refs.add(*row)
+        refs.loaded.append(tuple(row))
+    missing = [key for key in names if key not in refs.by_name]
+    if missing:
+        await session.execute(
+            insert_ignore(session, db_model)
+            .values([{"name": names[key], "normalized_name": key} for key in missing])
+            .on_conflict_do_nothing(index_elements=["normalized_name"])
+        )
+        for row in (await session.execute(
+            select(db_model.id, db_model.name, db_model.normalized_name)
+            .filter(db_model.normalized_name.in_(missing))
+        )).fetchall():
+            refs.add(*row)
+            refs.loaded.append(tuple(row))
+    return refs
+
+
+async def add_event_subjects(session, links):
+    """Insert (event, subject) links in one statement, skipping pairs that already exist."""
+    links = list(links)
+    # keep each statement well under sqlite's bound parameter limit
+    for i in range(0, len(links), 400):
+        await session.execute(
+            insert_ignore(session, EventSubject)
+            .values([{"event": event_id, "subject": subject_id} for event_id, subject_id in links[i:i + 400]])
+            .on_conflict_do_nothing(index_elements=["event", "subject"])
+        )
@@ -0,0 +1,40 @@
+# coding: utf-8
+
+import os
+
+from alembic import command
+from alembic.config import Config
+
+import httpx
+
+from settings import BASEDIR
+
+
+def migrate(path):
+    """Create the schema in the sqlite file at ``path`` with the alembic revisions."""
+    config = Config(os.path.join(BASEDIR, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(BASEDIR, "alembic"))
+    config.set_main_option("sqlalchemy.url", "sqlite:///{}".format(path))
+    command.upgrade(config, "head")
+
+
+def use_database(path):
+    """Point the application at the sqlite file at ``path``.
+
+    Must be called before the first session is opened.
+    """
+    from models import session as db
+    db.DATABASES["default"] = "sqlite+aiosqlite:///{}".format(path)
+
+
+def client(app):
+    """In-process client; unhandled errors come back as 500 responses instead of raising."""
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app, raise_app_exceptions=False), base_url="http://bench",
+    )
+
+
+async def login(c, username="bench", password="bench"):
+    await c.post("/v1/auth/create", json={"username": username, "password": password})
+    r = await c.post("/v1/auth", json={"username": username, "password": password})
+    return {"authorization": "Bearer {}".format(r.json()["access_token"])}
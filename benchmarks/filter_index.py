@@ -0,0 +1,73 @@
+# coding: utf-8
+
+"""Saved-filter matching: FilterIndex vs. a linear scan over every filter.
+
+    python -m benchmarks.filter_index [filters] [events]
+"""
+
+import datetime
+import random
+import sys
+import time
+
+from filter_index import FilterIndex
+
+
+CITIES = 500
+SUBJECTS = 2000
+EPOCH = datetime.datetime(2021, 1, 1)
+
+
+def _random_window(rnd, max_days):
+    start = EPOCH + datetime.timedelta(days=rnd.randrange(365), hours=rnd.randrange(24))
+    return start, start + datetime.timedelta(days=rnd.randrange(max_days) + 1)
+
+
+def _random_filter(rnd):
+    city = rnd.randrange(CITIES) if rnd.random() < 0.9 else None
+    start, end = _random_window(rnd, 30) if rnd.random() < 0.8 else (None, None)
+    subjects = rnd.sample(range(SUBJECTS), rnd.randrange(4))
+    return city, start, end, subjects
+
+
+def _random_event(rnd):
+    start, end = _random_window(rnd, 2)
+    return rnd.randrange(CITIES), start, end, rnd.sample(range(SUBJECTS), rnd.randrange(1, 4))
+
+
+def main(n_filters, n_events):
+    rnd = random.Random(42)
+    index = FilterIndex()
+    t = time.perf_counter()
+    for i in range(n_filters):
+        index.add(i, i % 10000, *_random_filter(rnd))
+    print("built index of {} filters in {:.1f}s".format(n_filters, time.perf_counter() - t))
+
+    events = [_random_event(rnd) for _ in range(n_events)]
+    t = time.perf_counter()
+    matched = sum(len(index.match(*e)) for e in events)
+    indexed = (time.perf_counter() - t) / n_events
+    print("indexed match: {:9.3f} ms/event ({:.1f} filters matched on average)".format(
+        indexed * 1000, matched / n_events))
+
+    scanned = events[:max(1, n_events // 100)]
+    t = time.perf_counter()
+    for city, start_time, end_time, subjects in scanned:
+        start, end, subjects = start_time.timestamp(), end_time.timestamp(), frozenset(subjects)
+        [
+            rec.id for rec in index.filters.values()
+            if (rec.city is None or rec.city == city) and
+            (rec.start is None or rec.start <= end) and
+            (rec.end is None or rec.end >= start) and
+            (not rec.subjects or not rec.subjects.isdisjoint(subjects))
+        ]
+    linear = (time.perf_counter() - t) / len(scanned)
+    print("linear scan:   {:9.3f} ms/event".format(linear * 1000))
+    print("speedup:       {:9.1f}x".format(linear / indexed))
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1000000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 1000,
+    )
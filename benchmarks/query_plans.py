@@ -0,0 +1,122 @@
+# coding: utf-8
+
+"""Fail when a query emitted by the routes falls back to a table scan.
+
+Every route below is driven in-process against a migrated sqlite database.
+Each SELECT it sends is re-run under EXPLAIN QUERY PLAN, and any
+``SCAN <table>`` that does not use an index is a regression. A scenario
+may allow a table to be walked by rowid (e.g. the unfiltered listing),
+which only covers statements that read it in ``<table>.id`` order up to a
+LIMIT, without aggregates or a sort, so the walk stops after a page.
+
+    python -m benchmarks.query_plans
+"""
+
+import asyncio
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+from sqlalchemy import event
+
+from benchmarks.common import migrate, use_database, client, login
+
+
+SCENARIOS = [
+    # (method, url, json body, tables allowed to be walked by rowid up to a LIMIT)
+    ("GET", "/v1/events", None, {"events"}),
+    ("GET", "/v1/events?cursor=", None, {"events"}),
+    ("GET", "/v1/events?city=1", None, set()),
+    ("GET", "/v1/events?subjects=1,2", None, {"events"}),
+    ("GET", "/v1/events?time_match=window&start_time=2021-06-02T00:00:00&end_time=2021-06-03T00:00:00", None, set()),
+    ("GET", "/v1/events?time_match=window&start_time=2021-06-02T00:00:00&city=1", None, set()),
+    ("GET", "/v1/events/search?q=event", None, set()),
+    ("GET", "/v1/events/search?q=event&city=1&subjects=1", None, set()),
+    ("GET", "/v1/events/filters", None, set()),
+    ("GET", "/v1/events/filters?cursor=", None, set()),
+]
+
+_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(.*)$")
+_AGGREGATE = re.compile(r"\b(?:count|max|min|sum|avg|total|group_concat)\s*\(|\bGROUP BY\b", re.IGNORECASE)
+
+
+def _rowid_walk(statement, details, table):
+    """Whether ``statement`` reads ``table`` in rowid order and stops at a LIMIT."""
+    statement = " ".join(statement.split())
+    return re.search(r"ORDER BY {}\.id(?: ASC)? LIMIT \S+(?: OFFSET \S+)?$".format(table), statement) is not None \
+        and not _AGGREGATE.search(statement) \
+        and not any("TEMP B-TREE" in d for d in details)
+
+
+def _table_scans(conn, statement, parameters, allowed=()):
+    """Tables ``statement`` scans without an index, less the allowed rowid walks."""
+    details = [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + statement, parameters)]
+    scans = []
+    for detail in details:
+        match = _SCAN.match(detail)
+        if match and "INDEX" not in match.group(2):
+            table = match.group(1)
+            if table not in allowed or not _rowid_walk(statement, details, table):
+                scans.append(table)
+    return scans
+
+
+async def _seed(c, headers):
+    for i in range(3):
+        await c.post(
+            "/v1/events/create",
+            headers=headers,
+            json={
+                "name": "event {}".format(i),
+                "start_time": "2021-06-0{}T10:00:00".format(i + 1),
+                "end_time": "2021-06-0{}T12:00:00".format(i + 1),
+                "city": {"name": "city {}".format(i % 2)},
+                "subjects": [{"name": "subject {}".format(i)}],
+            },
+        )
+    await c.post(
+        "/v1/events/filters/save",
+        headers=headers,
+        json={"city": 1, "subjects": [1]},
+    )
+
+
+async def main():
+    from main import app
+    from models.session import get_engine, dispose_engines
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "plans.sqlite3")
+        migrate(path)
+        use_database(path)
+        captured = []
+
+        @event.listens_for(get_engine().sync_engine, "before_cursor_execute")
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith("SELECT"):
+                captured.append((statement, parameters))
+
+        conn = sqlite3.connect(path)
+        async with client(app) as c:
+            headers = await login(c)
+            await _seed(c, headers)
+            for method, url, body, allowed in SCENARIOS:
+                del captured[:]
+                await c.request(method, url, headers=headers, json=body)
+                for statement, parameters in captured:
+                    scans = _table_scans(conn, statement, parameters, allowed)
+                    if scans:
+                        failures += 1
+                        print("REGRESSION {} {}: scans {}".format(method, url, ", ".join(scans)))
+                        print("    " + " ".join(statement.split()))
+                print("checked {} {} ({} queries)".format(method, url, len(captured)))
+        conn.close()
+        await dispose_engines()
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if asyncio.run(main()) else 0)
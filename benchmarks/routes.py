@@ -0,0 +1,278 @@
+# coding: utf-8
+
+"""Throughput and latency of every route, driven in-process.
+
+A migrated sqlite database is seeded with bulk inserts, then each scenario
+is sent ``--requests`` times at every ``--concurrency`` level through an
+ASGI client. Results are printed and written as JSON with ``--output``.
+The run fails when a scenario answers with any error, and with
+``--baseline`` also when its p95 grows or its throughput drops by more
+than ``--threshold`` against the baseline file.
+
+    python -m benchmarks.routes --events 100000 --concurrency 1,8,32 --output routes.json
+    python -m benchmarks.routes --baseline routes.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+from benchmarks.common import migrate, use_database, client, login
+from models.base import normalize_name
+from models.models import City, Subject, Event, EventSubject, UserFilter, FilterSubject
+
+
+EPOCH = datetime.datetime(2021, 1, 1)
+# 2500 made-up words for event names, so searches see a realistic spread of terms
+SYLLABLES = [c + v for c in "bdfgklmnprstvz" for v in "aeiou"][:50]
+WORDS = [a + b for a in SYLLABLES for b in SYLLABLES]
+SEED_CHUNK = 10000
+USERS = 1000
+
+
+def _insert(conn, table, rows):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, SEED_CHUNK))
+        if not chunk:
+            break
+        conn.execute(table.insert(), chunk)
+
+
+def seed(path, user_id, events, subjects, cities, filters, rnd):
+    """Fill the database with bulk inserts and return sample values for the listing filters.
+
+    Every USERS-th saved filter belongs to ``user_id``, the others to ids
+    that have no account.
+    """
+    engine = create_engine("sqlite:///{}".format(path))
+    times = [EPOCH + datetime.timedelta(hours=rnd.randrange(365 * 24)) for _ in range(1000)]
+    with engine.begin() as conn:
+        _insert(conn, City.__table__, (
+            {"name": "city {}".format(i), "normalized_name": normalize_name("city {}".format(i))}
+            for i in range(cities)
+        ))
+        _insert(conn, Subject.__table__, (
+            {"name": "subject {}".format(i), "normalized_name": normalize_name("subject {}".format(i))}
+            for i in range(subjects)
+        ))
+        _insert(conn, Event.__table__, (
+            {
+                "user_id": user_id, "name": " ".join(rnd.choice(WORDS) for _ in range(3)),
+                "city": rnd.randrange(cities) + 1,
+                "start_time": times[i % len(times)], "end_time": times[i % len(times)] + datetime.timedelta(hours=2),
+            }
+            for i in range(events)
+        ))
+        _insert(conn, EventSubject.__table__, (
+            {"event": i + 1, "subject": s + 1}
+            for i in range(events)
+            for s in rnd.sample(range(subjects), min(subjects, rnd.randrange(1, 4)))
+        ))
+        _insert(conn, UserFilter.__table__, (
+            {
+                "user_id": user_id if i % USERS == 0 else i % USERS + 1,
+                "city": rnd.randrange(cities) + 1 if rnd.random() < 0.9 else None,
+                "start_time": times[i % len(times)], "end_time": times[i % len(times)] + datetime.timedelta(days=7),
+            }
+            for i in range(filters)
+        ))
+        _insert(conn, FilterSubject.__table__, (
+            {"filter": i + 1, "subject": s + 1}
+            for i in range(filters)
+            for s in rnd.sample(range(subjects), min(subjects, rnd.randrange(3)))
+        ))
+        sample = conn.execute(
+            Event.__table__.select().where(Event.id == events // 2 + 1)
+        ).mappings().first()
+        subject = conn.execute(
+            EventSubject.__table__.select().where(EventSubject.event == sample["id"])
+        ).mappings().first()
+    engine.dispose()
+    return {
+        "search": " ".join(sample["name"].split()[:2]),
+        "window_start": (sample["start_time"] - datetime.timedelta(hours=12)).isoformat(),
+        "window_end": (sample["start_time"] + datetime.timedelta(hours=12)).isoformat(),
+        "city": sample["city"],
+        "start_time": sample["start_time"].isoformat(),
+        "end_time": sample["end_time"].isoformat(),
+        "subjects": str(subject["subject"]),
+    }
+
+
+def scenarios(headers, tokens, sample):
+    """(name, request factory) pairs; factories return (method, url, kwargs)."""
+    res = [
+        ("POST /v1/auth", lambda: ("POST", "/v1/auth", {"json": {"username": "bench", "password": "bench"}})),
+        ("POST /v1/auth/refresh", lambda: (
+            "POST", "/v1/auth/refresh", {"json": {"refresh_token": tokens["refresh_token"]}},
+        )),
+        ("GET /v1/auth/account/info", lambda: ("GET", "/v1/auth/account/info", {"headers": headers})),
+        ("POST /v1/events/create", lambda: ("POST", "/v1/events/create", {"headers": headers, "json": {
+            "name": "bench event", "start_time": sample["start_time"], "end_time": sample["end_time"],
+            "city": {"id": sample["city"]}, "subjects": [{"id": int(sample["subjects"])}],
+        }})),
+    ]
+    keys = ("city", "start_time", "end_time", "subjects")
+    for n in range(len(keys) + 1):
+        for combination in itertools.combinations(keys, n):
+            params = {k: sample[k] for k in combination}
+            res.append((
+                "GET /v1/events" + ("?" + "&".join(combination) if combination else ""),
+                lambda params=params: ("GET", "/v1/events", {"headers": headers, "params": params}),
+            ))
+    res += [
+        ("GET /v1/events?time_match=window", lambda: ("GET", "/v1/events", {"headers": headers, "params": {
+            "time_match": "window", "start_time": sample["window_start"], "end_time": sample["window_end"],
+        }})),
+        ("GET /v1/events?time_match=window&city", lambda: ("GET", "/v1/events", {"headers": headers, "params": {
+            "time_match": "window", "start_time": sample["window_start"], "end_time": sample["window_end"],
+            "city": sample["city"],
+        }})),
+        ("GET /v1/events/search?q", lambda: (
+            "GET", "/v1/events/search", {"headers": headers, "params": {"q": sample["search"]}},
+        )),
+        ("GET /v1/events/search?q&city&subjects", lambda: ("GET", "/v1/events/search", {"headers": headers, "params": {
+            "q": sample["search"], "city": sample["city"], "subjects": sample["subjects"],
+        }})),
+        ("GET /v1/events?cursor", lambda: ("GET", "/v1/events", {"headers": headers, "params": {"cursor": ""}})),
+        ("GET /v1/events/filters", lambda: ("GET", "/v1/events/filters", {"headers": headers})),
+        ("POST /v1/events/filters/save", lambda: ("POST", "/v1/events/filters/save", {"headers": headers, "json": {
+            "city": sample["city"], "start_time": sample["start_time"], "end_time": sample["end_time"],
+            "subjects": [int(sample["subjects"])],
+        }})),
+    ]
+    return res
+
+
+def _percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run(c, make_request, requests, concurrency):
+    latencies = []
+    errors = 0
+    pending = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in pending:
+            method, url, kwargs = make_request()
+            t = time.perf_counter()
+            r = await c.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - t)
+            if r.status_code >= 400:
+                errors += 1
+
+    t = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - t
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "rps": requests / elapsed,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p95_ms": _percentile(latencies, 0.95) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+    }
+
+
+def regressions(results, baseline, threshold):
+    previous = {(r["route"], r["concurrency"]): r for r in baseline["results"]}
+    res = []
+    for r in results:
+        b = previous.get((r["route"], r["concurrency"]))
+        if r["errors"]:
+            res.append("{} c={}: {} of {} requests failed{}".format(
+                r["route"], r["concurrency"], r["errors"], r["requests"],
+                " (baseline {})".format(b["errors"]) if b is not None else ""))
+        if b is None:
+            continue
+        if r["p95_ms"] > b["p95_ms"] * (1 + threshold):
+            res.append("{} c={}: p95 {:.2f}ms -> {:.2f}ms".format(r["route"], r["concurrency"], b["p95_ms"], r["p95_ms"]))
+        if r["rps"] * (1 + threshold) < b["rps"]:
+            res.append("{} c={}: {:.1f} -> {:.1f} req/s".format(r["route"], r["concurrency"], b["rps"], r["rps"]))
+    return res
+
+
+async def main(args):
+    from main import app
+    from models.session import dispose_engines
+    from base_obj import principal_cache
+    from v1.events import events_cache
+
+    if args.no_cache:
+        principal_cache.maxsize = events_cache.maxsize = 0
+    rnd = random.Random(args.seed)
+    levels = [int(i) for i in args.concurrency.split(",")]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "routes.sqlite3")
+        migrate(path)
+        use_database(path)
+        async with client(app) as c:
+            headers = await login(c)
+            t = time.perf_counter()
+            sample = seed(path, 1, args.events, args.subjects, args.cities, args.filters, rnd)
+            print("seeded in {:.1f}s".format(time.perf_counter() - t), file=sys.stderr)
+            await app.router.startup()
+            tokens = (await c.post("/v1/auth", json={"username": "bench", "password": "bench"})).json()
+            only = set(args.only.split(",")) if args.only else None
+            for name, make_request in scenarios(headers, tokens, sample):
+                if only and name not in only:
+                    continue
+                for concurrency in levels:
+                    r = dict(route=name, concurrency=concurrency,
+                             **await run(c, make_request, args.requests, concurrency))
+                    results.append(r)
+                    print("{:<45} c={:<4} {:9.1f} req/s  p50 {:8.2f}  p95 {:8.2f}  p99 {:8.2f} ms  errors {}".format(
+                        name, concurrency, r["rps"], r["p50_ms"], r["p95_ms"], r["p99_ms"], r["errors"]))
+            await app.router.shutdown()
+        await dispose_engines()
+
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    baseline = {"results": []}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    failed = regressions(results, baseline, args.threshold)
+    for line in failed:
+        print("REGRESSION " + line)
+    return 1 if failed else 0
+
+
+def _parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--subjects", type=int, default=1000)
+    parser.add_argument("--cities", type=int, default=100)
+    parser.add_argument("--filters", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario and concurrency level")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma separated concurrency levels")
+    parser.add_argument("--only", help="comma separated scenario names")
+    parser.add_argument("--no-cache", action="store_true", help="disable the principal and events caches")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative regression")
+    return parser
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(_parser().parse_args())))
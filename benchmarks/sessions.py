@@ -0,0 +1,55 @@
+# coding: utf-8
+
+"""Sessions per second: a fresh engine per session vs. the engine registry.
+
+    python -m benchmarks.sessions [seconds]
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+
+from models import session as db
+
+
+async def _per_session_engine(url, seconds):
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        engine = create_async_engine(url)
+        async with AsyncSession(bind=engine) as s:
+            await s.execute(text("SELECT 1"))
+        await engine.dispose()
+        count += 1
+    return count / seconds
+
+
+async def _registry(seconds):
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        async with db.get_session() as s:
+            await s.execute(text("SELECT 1"))
+        count += 1
+    return count / seconds
+
+
+async def main(seconds):
+    with tempfile.TemporaryDirectory() as tmp:
+        url = "sqlite+aiosqlite:///{}".format(os.path.join(tmp, "bench.sqlite3"))
+        db.DATABASES["default"] = url
+        before = await _per_session_engine(url, seconds)
+        after = await _registry(seconds)
+        await db.dispose_engines()
+    print("engine per session: {:10.1f} sessions/s".format(before))
+    print("engine registry:    {:10.1f} sessions/s".format(after))
+    print("speedup:            {:10.1f}x".format(after / before))
+
+
+if __name__ == "__main__":
+    asyncio.run(main(float(sys.argv[1]) if len(sys.argv) > 1 else 3.0))
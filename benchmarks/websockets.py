@@ -0,0 +1,248 @@
+# coding: utf-8
+
+"""Websocket fan-out with thousands of idle and active connections.
+
+Simulated clients are driven through the ASGI interface of ``/ws/{id}``
+(no sockets), so the numbers cover the endpoint, token check and the
+connection manager, plus the clients themselves. The run reports:
+
+* connect: time and resident memory for ``--connections`` sockets;
+* idle: event loop lag while every connection is pinged and answers;
+* broadcast: delivery latency of one message to every connection;
+* burst: ``--burst`` messages per connection at once, coalesced into
+  batch frames and capped at the per-connection queue size;
+* dead peers (``--dead``) closed by the heartbeat and slow peers
+  (``--slow``) closed by the send timeout.
+
+    python -m benchmarks.websockets --connections 10000
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+
+import jwt
+
+from sqlalchemy import create_engine
+
+from benchmarks.common import migrate, use_database
+from models.models import Users
+from settings import SERVER_SECRET
+
+
+def _rss_mb():
+    """Current resident set size, the peak one where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def seed(path, users):
+    """Insert ``users`` accounts and return an access token for each of them."""
+    engine = create_engine("sqlite:///{}".format(path))
+    with engine.begin() as conn:
+        conn.execute(Users.__table__.insert(), [
+            {"username": "ws{}".format(i), "salt": "", "password": "bench", "updated_at": datetime.datetime.utcnow()}
+            for i in range(users)
+        ])
+    engine.dispose()
+    expiration_time = datetime.datetime.now().timestamp() + 3600
+    return {
+        user_id: jwt.encode(
+            {"user_id": user_id, "username": "ws{}".format(user_id - 1), "password": "bench",
+             "expiration_time": expiration_time},
+            SERVER_SECRET, algorithm="HS256",
+        )
+        for user_id in range(1, users + 1)
+    }
+
+
+class Client:
+    """One simulated websocket peer.
+
+    ``mode`` is "ok" (answers pings), "dead" (never answers) or "slow"
+    (never finishes reading a frame).
+    """
+
+    def __init__(self, user_id, token, mode):
+        self.user_id = user_id
+        self.token = token
+        self.mode = mode
+        self.inbox = asyncio.Queue()
+        self.accepted = asyncio.Event()
+        self.closed = None
+        self.frames = 0
+        self.messages = 0
+        self.pings = 0
+        self.received = {}
+        self.task = None
+
+    def scope(self):
+        path = "/ws/{}".format(self.user_id)
+        return {
+            "type": "websocket", "asgi": {"version": "3.0"}, "scheme": "ws", "root_path": "",
+            "path": path, "raw_path": path.encode("ascii"), "query_string": "token={}".format(self.token).encode(),
+            "headers": [], "client": ("127.0.0.1", 10000 + self.user_id % 50000), "server": ("bench", 80),
+            "subprotocols": [],
+        }
+
+    async def receive(self):
+        return await self.inbox.get()
+
+    async def send(self, message):
+        kind = message["type"]
+        if kind == "websocket.accept":
+            self.accepted.set()
+        elif kind == "websocket.close":
+            self.closed = message.get("code")
+            self.accepted.set()
+            self.inbox.put_nowait({"type": "websocket.disconnect", "code": self.closed})
+        elif kind == "websocket.send":
+            if self.mode == "slow":
+                await asyncio.Event().wait()
+            now = time.perf_counter()
+            frame = json.loads(message["text"])
+            self.frames += 1
+            for m in frame["messages"] if frame["type"] == "batch" else [frame]:
+                if m["type"] == "ping":
+                    self.pings += 1
+                    if self.mode == "ok":
+                        self.inbox.put_nowait({"type": "websocket.receive", "text": '{"type": "pong"}'})
+                else:
+                    self.messages += 1
+                    self.received[m["round"]] = now
+
+    def open(self, app):
+        self.inbox.put_nowait({"type": "websocket.connect"})
+        self.task = asyncio.create_task(app(self.scope(), self.receive, self.send))
+
+
+async def loop_lag(seconds, interval=0.01):
+    """Worst delay of a ``interval`` sleep over ``seconds``."""
+    worst = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        t = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - t - interval)
+    return worst
+
+
+async def wait_for(predicate, timeout):
+    deadline = time.perf_counter() + timeout
+    while not predicate() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    return predicate()
+
+
+def _percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0
+
+
+async def main(args):
+    from main import app
+    from models.session import dispose_engines
+    from notifications import manager
+    from metrics import ws_messages_dropped, ws_closed
+
+    manager.ping_interval = args.ping_interval
+    manager.ping_timeout = args.ping_interval * 2.5
+    manager.send_timeout = args.send_timeout
+    rnd = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "websockets.sqlite3")
+        migrate(path)
+        use_database(path)
+        users = args.users or args.connections
+        tokens = seed(path, users)
+        await app.router.startup()
+
+        rss = _rss_mb()
+        t = time.perf_counter()
+        clients = []
+        for i in range(args.connections):
+            user_id = i % users + 1
+            r = rnd.random()
+            mode = "dead" if r < args.dead else "slow" if r < args.dead + args.slow else "ok"
+            client = Client(user_id, tokens[user_id], mode)
+            client.open(app)
+            clients.append(client)
+        await asyncio.gather(*[c.accepted.wait() for c in clients])
+        elapsed = time.perf_counter() - t
+        print("connect    {:6d} sockets in {:6.2f}s, {:6d} open, rss +{:.1f} MB ({:.1f} KB per socket)".format(
+            len(clients), elapsed, len(manager), _rss_mb() - rss, (_rss_mb() - rss) * 1024 / len(clients)))
+
+        ok = [c for c in clients if c.mode == "ok"]
+        lag = await loop_lag(args.ping_interval * 2.5)
+        print("idle       pings answered by {}/{} clients, worst loop lag {:.1f} ms".format(
+            sum(1 for c in ok if c.pings), len(ok), lag * 1000))
+
+        # slow peers hold the first frame until the send timeout, dead ones until the ping timeout
+        await wait_for(lambda: all(c.closed is not None for c in clients if c.mode != "ok"), manager.ping_timeout * 3)
+        print("peers      {} dead closed by heartbeat, {} slow closed by send timeout, {} healthy open".format(
+            ws_closed.values.get(("ping_timeout", ), 0), ws_closed.values.get(("send_timeout", ), 0),
+            sum(1 for c in ok if c.closed is None)))
+
+        user_ids = list(manager.connections)
+        latencies = []
+        t = time.perf_counter()
+        for n in range(args.rounds):
+            sent = time.perf_counter()
+            manager.send(user_ids, {"type": "event", "round": n})
+            await wait_for(lambda: all(n in c.received for c in ok if c.closed is None), 30)
+            latencies += sorted(c.received[n] - sent for c in ok if n in c.received)
+        elapsed = time.perf_counter() - t
+        latencies.sort()
+        print("broadcast  {} rounds to {} sockets, {:.0f} messages/s, latency p50 {:.1f} p99 {:.1f} max {:.1f} ms".format(
+            args.rounds, len(ok), args.rounds * len(ok) / elapsed,
+            _percentile(latencies, 0.5) * 1000, _percentile(latencies, 0.99) * 1000, latencies[-1] * 1000))
+
+        frames = sum(c.frames for c in ok)
+        messages = sum(c.messages for c in ok)
+        dropped = ws_messages_dropped.values.get((), 0)
+        rss = _rss_mb()
+        t = time.perf_counter()
+        for n in range(args.rounds, args.rounds + args.burst):
+            manager.send(user_ids, {"type": "event", "round": n})
+        peak = _rss_mb()
+        last = args.rounds + args.burst - 1
+        await wait_for(lambda: all(last in c.received for c in ok if c.closed is None), 60)
+        elapsed = time.perf_counter() - t
+        print("burst      {} messages to {} sockets in {:.2f}s: {} frames, {} delivered, {} dropped, "
+              "queues +{:.1f} MB".format(
+                  args.burst, len(ok), elapsed, sum(c.frames for c in ok) - frames,
+                  sum(c.messages for c in ok) - messages, ws_messages_dropped.values.get((), 0) - dropped,
+                  peak - rss))
+        print("closed     {}".format(", ".join(
+            "{} {}".format(count, reason) for (reason, ), count in sorted(ws_closed.values.items())
+        )))
+
+        await app.router.shutdown()
+        await asyncio.gather(*[c.task for c in clients], return_exceptions=True)
+        await dispose_engines()
+
+
+def _parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--users", type=int, help="distinct users, defaults to one per connection")
+    parser.add_argument("--rounds", type=int, default=20, help="broadcast rounds")
+    parser.add_argument("--burst", type=int, default=200, help="messages per connection sent at once")
+    parser.add_argument("--ping-interval", type=float, default=1.0)
+    parser.add_argument("--send-timeout", type=float, default=1.0)
+    parser.add_argument("--dead", type=float, default=0.01, help="share of peers that never answer pings")
+    parser.add_argument("--slow", type=float, default=0.01, help="share of peers that never read")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser
+
+
+if __name__ == "__main__":
+    asyncio.run(main(_parser().parse_args()))
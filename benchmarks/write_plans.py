@@ -0,0 +1,92 @@
+# coding: utf-8
+
+"""Per-call CPU cost of create_update_record with cached write plans.
+
+The "reflection" baseline is the previous implementation of the insert
+branch, which walked ``db_model.__dict__`` and parsed timestamps with
+dateutil on every call. The session is a stand-in that does no I/O so only
+the Python work is measured.
+
+    python -m benchmarks.write_plans [calls]
+"""
+
+import asyncio
+import sys
+import time
+
+import dateutil.parser
+
+from sqlalchemy.orm.attributes import InstrumentedAttribute
+from sqlalchemy.sql.sqltypes import DateTime
+
+from base_obj import create_update_record, parse_datetime
+from models.models import Event
+from v1.request_models import EventWriteRequest
+
+
+class _NoIOSession:
+    def add(self, obj):
+        pass
+
+    async def flush(self):
+        pass
+
+
+class _User:
+    id = 1
+
+
+async def _reflection_insert(session, db_model, request_model, user):
+    db_dict = {}
+    for i in db_model.__dict__:
+        if i != "id" and \
+                isinstance(db_model.__dict__[i], InstrumentedAttribute) and \
+                i in request_model.__dict__.keys() and \
+                (db_model.__dict__[i].__getattr__("nullable") or request_model.__dict__[i] is not None):
+            if isinstance(db_model.__dict__[i].__getattr__("type"), DateTime):
+                db_dict[i] = dateutil.parser.parse(request_model.__dict__[i]) \
+                    if request_model.__dict__[i] is not None and request_model.__dict__[i] != -1 else None
+            else:
+                db_dict[i] = request_model.__dict__[i] \
+                    if request_model.__dict__[i] is not None and request_model.__dict__[i] != -1 else None
+    if "user_id" in db_model.__dict__.keys():
+        db_dict["user_id"] = user.id
+    r = db_model(**db_dict)
+    session.add(r)
+    await session.flush()
+    return r
+
+
+async def _timed(calls, make_call):
+    t = time.perf_counter()
+    for _ in range(calls):
+        await make_call()
+    return (time.perf_counter() - t) / calls * 1e6
+
+
+async def main(calls):
+    session, user = _NoIOSession(), _User()
+    request = EventWriteRequest.construct(
+        id=None, name="event", start_time="2021-06-01T10:00:00", end_time="2021-06-01T12:00:00+03:00", city=1,
+    )
+    fields = ["id", "name", "start_time", "end_time", "city"]
+    before = await _timed(calls, lambda: _reflection_insert(session, Event, request, user))
+    after = await _timed(calls, lambda: create_update_record(session, Event, fields, request, user))
+    print("reflection insert: {:8.2f} us/call".format(before))
+    print("write plan insert: {:8.2f} us/call".format(after))
+
+    value = "2021-06-01T12:00:00+03:00"
+    t = time.perf_counter()
+    for _ in range(calls):
+        dateutil.parser.parse(value)
+    dateutil_us = (time.perf_counter() - t) / calls * 1e6
+    t = time.perf_counter()
+    for _ in range(calls):
+        parse_datetime(value)
+    iso_us = (time.perf_counter() - t) / calls * 1e6
+    print("dateutil.parser:   {:8.2f} us/call".format(dateutil_us))
+    print("parse_datetime:    {:8.2f} us/call".format(iso_us))
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,92 @@
+# coding: utf-8
+
+"""Write throughput under mixed read/write load.
+
+Writers create events while readers page through GET /v1/events, first
+with rollback journaling and every request committing on its own pooled
+connection, then with the WAL profile and the group-committing write queue.
+
+    python -m benchmarks.writes [seconds] [writers] [readers]
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.common import migrate, use_database, client, login
+
+
+MODES = [
+    # (name, pragma overrides, start the write queue)
+    ("rollback journal, pooled writes", {"journal_mode": "DELETE", "synchronous": "FULL"}, False),
+    ("WAL, write queue", {}, True),
+]
+
+
+async def _load(c, headers, seconds, writers, readers):
+    deadline = time.perf_counter() + seconds
+    writes, write_errors, read_latencies = [0], [0], []
+
+    async def writer(n):
+        i = 0
+        while time.perf_counter() < deadline:
+            r = await c.post("/v1/events/create", headers=headers, json={
+                "name": "event {} {}".format(n, i), "city": {"name": "city {}".format(i % 10)},
+                "subjects": [{"name": "subject {}".format(i % 20)}],
+            })
+            i += 1
+            if r.status_code == 200:
+                writes[0] += 1
+            else:
+                write_errors[0] += 1
+
+    async def reader():
+        while time.perf_counter() < deadline:
+            t = time.perf_counter()
+            await c.get("/v1/events", headers=headers, params={"city": 1, "limit": 50})
+            read_latencies.append(time.perf_counter() - t)
+
+    await asyncio.gather(*[writer(n) for n in range(writers)], *[reader() for _ in range(readers)])
+    read_latencies.sort()
+    p95 = read_latencies[int(len(read_latencies) * 0.95)] if read_latencies else 0
+    return writes[0] / seconds, write_errors[0], len(read_latencies) / seconds, p95
+
+
+async def main(seconds, writers, readers):
+    from main import app
+    from models import session as db
+    from write_queue import write_queue
+    from v1.events import events_cache
+
+    # every write invalidates the page the readers ask for, keep reads honest
+    events_cache.maxsize = 0
+    defaults = dict(db.SQLITE_PRAGMAS)
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, (name, pragmas, queued) in enumerate(MODES):
+            path = os.path.join(tmp, "writes{}.sqlite3".format(i))
+            migrate(path)
+            use_database(path)
+            db.SQLITE_PRAGMAS.clear()
+            db.SQLITE_PRAGMAS.update(defaults, **pragmas)
+            if queued:
+                await write_queue.start()
+            async with client(app) as c:
+                headers = await login(c)
+                writes, errors, reads, p95 = await _load(c, headers, seconds, writers, readers)
+            if queued:
+                await write_queue.stop()
+            await db.dispose_engines()
+            print("{:<32} {:8.1f} writes/s  {:5d} failed  {:8.1f} reads/s  read p95 {:7.2f} ms".format(
+                name, writes, errors, reads, p95 * 1000))
+            if queued:
+                print("{:<32} {:8.1f} jobs per commit".format("", write_queue.jobs / max(1, write_queue.commits)))
+
+
+if __name__ == "__main__":
+    asyncio.run(main(
+        float(sys.argv[1]) if len(sys.argv) > 1 else 5.0,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 32,
+        int(sys.argv[3]) if len(sys.argv) > 3 else 8,
+    ))
@@ -0,0 +1,96 @@
+# coding: utf-8
+
+import time
+
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after ``ttl`` seconds.
+
+    Every entry may carry a set of tags so that related entries can be
+    dropped together with ``invalidate_tag``. The age of entries served on
+    hits is tracked to show how stale cached answers are.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._tags = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.hit_age_sum = 0.0
+        self.hit_age_max = 0.0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, created_at, tags = item
+        age = time.monotonic() - created_at
+        if age > self.ttl:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        self.hit_age_sum += age
+        if age > self.hit_age_max:
+            self.hit_age_max = age
+        return value
+
+    def set(self, key, value, tags=()):
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (value, time.monotonic(), tuple(tags))
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.maxsize:
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def invalidate(self, key):
+        if key in self._data:
+            self._remove(key)
+            self.invalidations += 1
+
+    def invalidate_tag(self, tag):
+        for key in list(self._tags.get(tag, ())):
+            self.invalidate(key)
+
+    def clear(self):
+        self._data.clear()
+        self._tags.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            "hit_age_avg": self.hit_age_sum / self.hits if self.hits else 0.0,
+            "hit_age_max": self.hit_age_max,
+        }
+
+    def _remove(self, key):
+        value, created_at, tags = self._data.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
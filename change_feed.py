@@ -0,0 +1,135 @@
+# coding: utf-8
+
+import asyncio
+import datetime
+import json
+import time
+import uuid
+
+from sqlalchemy import delete, func
+from sqlalchemy.future import select
+
+from settings import CHANGE_FEED_POLL_INTERVAL, CHANGE_FEED_BATCH_SIZE, CHANGE_LOG_RETENTION
+
+from models.session import get_session
+from models.models import ChangeLog
+from metrics import change_feed_changes, change_feed_resyncs
+from write_queue import write_queue
+
+
+# marks the rows written by this process, it updates its own caches after commit
+ORIGIN = uuid.uuid4().hex
+
+
+def change_row(kind, ref_id=None, **data):
+    """Column values of a ``change_log`` row, for writers holding a connection instead of a session."""
+    return {"kind": kind, "ref_id": ref_id, "data": json.dumps(data) if data else None, "origin": ORIGIN}
+
+
+def log_change(session, kind, ref_id=None, **data):
+    """Append a change to ``change_log`` in the session's transaction."""
+    session.add(ChangeLog(**change_row(kind, ref_id, **data)))
+
+
+class ChangeFeed:
+    """Applies the ``change_log`` rows committed by other workers to this process' caches.
+
+    Subscribers register ``async def apply(session, changes)`` per kind,
+    ``changes`` being the ``(ref_id, data)`` pairs read in one poll, and an
+    optional ``async def reset(session)`` that drops or reloads everything.
+    The sqlite writer commits one transaction at a time, so versions become
+    visible in order; a version missing from the sequence means the rows
+    were pruned before this worker read them, and every subscriber resets.
+
+    ``poll`` also deletes rows older than ``retention`` seconds now and then,
+    always keeping the newest one so a fresh worker starts from the current
+    version.
+    """
+
+    def __init__(self, poll_interval=CHANGE_FEED_POLL_INTERVAL, batch_size=CHANGE_FEED_BATCH_SIZE,
+                 retention=CHANGE_LOG_RETENTION):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.retention = retention
+        self.handlers = {}
+        self.resets = []
+        self.version = None
+        self.task = None
+        self.pruned_at = 0
+
+    def subscribe(self, kind, apply, reset=None):
+        self.handlers[kind] = apply
+        if reset is not None:
+            self.resets.append(reset)
+
+    async def start(self):
+        """Start from the current version; call before loading the caches so nothing is missed."""
+        async with get_session() as s:
+            self.version = (await s.execute(select(func.max(ChangeLog.id)))).scalar() or 0
+        self.pruned_at = time.monotonic()
+        if self.poll_interval:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                while await self.poll() == self.batch_size:
+                    pass
+                if time.monotonic() - self.pruned_at >= self.retention / 10:
+                    await self.prune()
+            except Exception as e:
+                print("change feed poll failed: {}".format(e))
+
+    async def poll(self):
+        """Apply the changes committed since the last poll, return the number of rows read."""
+        async with get_session() as s:
+            rows = (await s.execute(
+                select(ChangeLog.id, ChangeLog.kind, ChangeLog.ref_id, ChangeLog.data, ChangeLog.origin)
+                .filter(ChangeLog.id > self.version)
+                .order_by(ChangeLog.id)
+                .limit(self.batch_size)
+            )).fetchall()
+            if not rows:
+                return 0
+            if rows[0].id != self.version + 1:
+                change_feed_resyncs.inc()
+                for reset in self.resets:
+                    await reset(s)
+            else:
+                changes = {}
+                for row in rows:
+                    if row.origin != ORIGIN:
+                        changes.setdefault(row.kind, []).append((row.ref_id, json.loads(row.data) if row.data else {}))
+                for kind, items in changes.items():
+                    apply = self.handlers.get(kind)
+                    if apply is not None:
+                        await apply(s, items)
+                    change_feed_changes.inc(kind, amount=len(items))
+        self.version = rows[-1].id
+        return len(rows)
+
+    async def prune(self):
+        self.pruned_at = time.monotonic()
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.retention)
+
+        async def write(s):
+            newest = select(func.max(ChangeLog.id)).scalar_subquery()
+            await s.execute(
+                delete(ChangeLog)
+                .where(ChangeLog.created_at < cutoff, ChangeLog.id < newest)
+                .execution_options(synchronize_session=False)
+            )
+        await write_queue.submit(write)
+
+
+change_feed = ChangeFeed()
@@ -0,0 +1,175 @@
+# coding: utf-8
+
+from collections import namedtuple
+
+from sqlalchemy.future import select
+
+from settings import FILTER_INDEX_BUCKET_SIZE, FILTER_INDEX_MAX_BUCKETS
+
+from change_feed import change_feed
+
+from models.session import get_session
+from models.models import UserFilter, FilterSubject
+
+
+SavedFilter = namedtuple("SavedFilter", ["id", "user_id", "city", "start", "end", "subjects"])
+
+
+def _ts(value):
+    return value.timestamp() if value is not None else None
+
+
+class FilterIndex:
+    """Saved filters indexed for matching against events.
+
+    Each filter is filed under the keys of its most specific criteria:
+    ``("cs", city, subject)`` for every subject when it has a city and
+    subjects, ``("cb", city, bucket)`` for every time bucket of
+    ``bucket_size`` seconds when it has a city and a bounded window,
+    ``("c", city)`` when it only has a city, and likewise ``("s", subject)``,
+    ``("b", bucket)`` and ``("*",)`` for filters without a city. Windows
+    spanning more than ``max_buckets`` buckets are not bucketed.
+
+    An event only looks up the keys it can match and checks each candidate
+    against the full predicate, so the cost follows the number of plausible
+    filters rather than the size of the index.
+    """
+
+    def __init__(self, bucket_size=FILTER_INDEX_BUCKET_SIZE, max_buckets=FILTER_INDEX_MAX_BUCKETS):
+        self.bucket_size = bucket_size
+        self.max_buckets = max_buckets
+        self.filters = {}
+        self.index = {}
+        # bucketed filters per city (None for filters without a city), used
+        # when the event window is too wide to enumerate its buckets
+        self.bucketed = {}
+
+    def __len__(self):
+        return len(self.filters)
+
+    def clear(self):
+        self.filters.clear()
+        self.index.clear()
+        self.bucketed.clear()
+
+    def _buckets(self, start, end):
+        if start is None or end is None:
+            return None
+        first, last = int(start // self.bucket_size), int(end // self.bucket_size)
+        if last - first >= self.max_buckets:
+            return None
+        return range(first, last + 1)
+
+    def _keys(self, rec):
+        if rec.subjects:
+            if rec.city is not None:
+                return [("cs", rec.city, s) for s in rec.subjects]
+            return [("s", s) for s in rec.subjects]
+        buckets = self._buckets(rec.start, rec.end)
+        if buckets is None:
+            return [("c", rec.city)] if rec.city is not None else [("*",)]
+        if rec.city is not None:
+            return [("cb", rec.city, b) for b in buckets]
+        return [("b", b) for b in buckets]
+
+    def add(self, filter_id, user_id, city, start_time, end_time, subjects):
+        """Add or replace a saved filter; times are datetimes or None."""
+        if filter_id in self.filters:
+            self.remove(filter_id)
+        rec = SavedFilter(filter_id, user_id, city, _ts(start_time), _ts(end_time), frozenset(subjects))
+        self.filters[filter_id] = rec
+        keys = self._keys(rec)
+        for key in keys:
+            self.index.setdefault(key, set()).add(filter_id)
+        if keys[0][0] in ("cb", "b"):
+            self.bucketed.setdefault(rec.city, set()).add(filter_id)
+
+    def remove(self, filter_id):
+        rec = self.filters.pop(filter_id, None)
+        if rec is None:
+            return
+        keys = self._keys(rec)
+        for key in keys:
+            self._discard(self.index, key, filter_id)
+        if keys[0][0] in ("cb", "b"):
+            self._discard(self.bucketed, rec.city, filter_id)
+
+    @staticmethod
+    def _discard(index, key, filter_id):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(filter_id)
+            if not ids:
+                del index[key]
+
+    def _candidates(self, city, start, end, subjects):
+        index = self.index
+        keys = [("*",)] + [("s", s) for s in subjects]
+        if city is not None:
+            keys += [("c", city)] + [("cs", city, s) for s in subjects]
+        buckets = self._buckets(start, end)
+        if buckets is not None:
+            keys += [("b", b) for b in buckets]
+            if city is not None:
+                keys += [("cb", city, b) for b in buckets]
+        res = [index[k] for k in keys if k in index]
+        if buckets is None:
+            res += [self.bucketed[c] for c in (None, city) if c in self.bucketed]
+        return res
+
+    def match(self, city, start_time, end_time, subjects):
+        """Return ids of the saved filters matching an event."""
+        start, end = _ts(start_time), _ts(end_time)
+        subjects = frozenset(subjects)
+        res = set()
+        for ids in self._candidates(city, start, end, subjects):
+            for filter_id in ids:
+                rec = self.filters[filter_id]
+                if (rec.city is None or rec.city == city) and \
+                        (rec.start is None or end is None or rec.start <= end) and \
+                        (rec.end is None or start is None or rec.end >= start) and \
+                        (not rec.subjects or not rec.subjects.isdisjoint(subjects)):
+                    res.add(filter_id)
+        return res
+
+    def match_users(self, city, start_time, end_time, subjects):
+        return {self.filters[i].user_id for i in self.match(city, start_time, end_time, subjects)}
+
+    async def load(self, session, ids=None):
+        """Rebuild the index from ``user_filters`` and ``filters_subjects``.
+
+        With ``ids`` only those filters are re-read, the ones gone from the
+        database are removed.
+        """
+        subjects = {}
+        query = select(FilterSubject.filter, FilterSubject.subject)
+        if ids is not None:
+            query = query.filter(FilterSubject.filter.in_(ids))
+        result = await session.stream(query)
+        async for filter_id, subject in result:
+            subjects.setdefault(filter_id, []).append(subject)
+        query = select(UserFilter.id, UserFilter.user_id, UserFilter.city, UserFilter.start_time, UserFilter.end_time)
+        if ids is None:
+            self.clear()
+        else:
+            query = query.filter(UserFilter.id.in_(ids))
+            for filter_id in ids:
+                self.remove(filter_id)
+        result = await session.stream(query)
+        async for filter_id, user_id, city, start_time, end_time in result:
+            self.add(filter_id, user_id, city, start_time, end_time, subjects.get(filter_id, ()))
+
+
+filter_index = FilterIndex()
+
+
+async def load_filter_index():
+    async with get_session() as s:
+        await filter_index.load(s)
+
+
+async def _apply_filter_changes(session, changes):
+    await filter_index.load(session, {filter_id for filter_id, data in changes})
+
+
+change_feed.subscribe("filter", _apply_filter_changes, filter_index.load)
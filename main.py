@@ -1,29 +1,77 @@
 # coding: utf-8
 
-from fastapi import FastAPI, WebSocket
+from typing import Optional
 
-from models.session import get_session
+from fastapi import FastAPI, WebSocket, status
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import PlainTextResponse
+
+from models.session import get_session, dispose_engines
+
+from base_obj import check_token, principal_cache
+from filter_index import load_filter_index
+from notifications import manager
+from write_queue import write_queue
+from outbox import outbox
+from references import start_reference_refresh, stop_reference_refresh
+from change_feed import change_feed
+from metrics import MetricsMiddleware, instrument_sql, register_cache, render
 
 from v1.auth import router as auth_router
-from v1.events import router as events_router
+from v1.events import router as events_router, events_cache
+
+from settings import GZIP_MINIMUM_SIZE, METRICS_ENABLED
 
 
 app = FastAPI(root_path="/api")
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    instrument_sql()
+
+register_cache("principal", principal_cache)
+register_cache("events", events_cache)
 
 app.include_router(auth_router)
 app.include_router(events_router)
 
 
+@app.on_event("startup")
+async def startup() -> None:
+    await change_feed.start()
+    await start_reference_refresh()
+    await load_filter_index()
+    await write_queue.start()
+    await outbox.start()
+    await manager.start()
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    await manager.stop()
+    await outbox.stop()
+    await change_feed.stop()
+    await write_queue.stop()
+    await stop_reference_refresh()
+    await dispose_engines()
+
+
 @app.get("/")
 async def root() -> dict:
     async with get_session() as s:
         return {"response": "Heil"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics() -> PlainTextResponse:
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+
 @app.websocket("/ws/{id}")
-async def notify(websocket: WebSocket):
+async def notify(websocket: WebSocket, id: int, token: Optional[str] = None):
+    code, reason, user_info = await check_token(token) if token else (None, None, None)
+    if code != status.HTTP_200_OK or user_info.id != id:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
     await websocket.accept()
-    while True:
-        data = await websocket.receive_json()
-
-        await websocket.send_text(f"New Event: {data.get('id')}")
+    await manager.serve(id, websocket)
@@ -0,0 +1,263 @@
+# coding: utf-8
+
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class Counter:
+    """Monotonic counter with one value per label tuple."""
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, self.labelnames, labels, value
+
+
+class Histogram:
+    """Cumulative-bucket histogram with one series per label tuple.
+
+    ``observe`` only bumps one bucket, the cumulative counts are built when
+    the histogram is rendered.
+    """
+
+    type = "histogram"
+
+    DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            # per-bucket counts (the last one is +Inf), then sum
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        labelnames = self.labelnames + ("le",)
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield self.name + "_bucket", labelnames, labels + (_format_bound(bound),), cumulative
+            yield self.name + "_sum", self.labelnames, labels, total
+            yield self.name + "_count", self.labelnames, labels, cumulative
+
+
+class Gauge:
+    """Gauge whose values are read from ``func`` at scrape time.
+
+    ``func`` returns a mapping of label tuples to values.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames, func):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.func = func
+
+    def samples(self):
+        for labels, value in self.func().items():
+            yield self.name, self.labelnames, labels, value
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+REGISTRY = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def render():
+    """Prometheus text exposition of every registered metric."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+        lines.append("# TYPE {} {}".format(metric.name, metric.type))
+        for name, labelnames, labels, value in metric.samples():
+            if labelnames:
+                name += "{" + ",".join(
+                    '{}="{}"'.format(k, _escape(v)) for k, v in zip(labelnames, labels)
+                ) + "}"
+            lines.append("{} {}".format(name, value))
+    return "\n".join(lines) + "\n"
+
+
+http_requests = register(Counter(
+    "http_requests_total", "HTTP requests by route template and status.", ("method", "route", "status"),
+))
+http_request_duration = register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template.", ("method", "route"),
+))
+http_request_queries = register(Histogram(
+    "http_request_queries", "SQL statements executed per HTTP request.", ("method", "route"),
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100),
+))
+db_statement_duration = register(Histogram(
+    "db_statement_duration_seconds", "SQL statement execution time by statement kind.", ("kind",),
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1),
+))
+db_sessions = register(Counter("db_sessions_total", "Database sessions opened."))
+db_pool_checkouts = register(Counter("db_pool_checkouts_total", "Connections checked out of the pools.", ("role",)))
+db_pool_checkout_timeouts = register(Counter(
+    "db_pool_checkout_timeouts_total", "Pool checkouts that gave up after DB_POOL_TIMEOUT.", ("role",),
+))
+db_pool_checkout_wait = register(Histogram(
+    "db_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection.", ("role",),
+    buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, 30),
+))
+change_feed_changes = register(Counter(
+    "change_feed_changes_total", "Changes of other workers applied from the change log.", ("kind",),
+))
+change_feed_resyncs = register(Counter(
+    "change_feed_resyncs_total", "Cache resets after missing pruned change log rows.",
+))
+ws_messages = register(Counter("ws_messages_total", "Messages queued for websocket connections."))
+ws_messages_dropped = register(Counter(
+    "ws_messages_dropped_total", "Queued websocket messages dropped because the connection fell behind.",
+))
+ws_frames = register(Counter("ws_frames_total", "Websocket frames sent, each carrying one or more messages."))
+ws_closed = register(Counter("ws_closed_total", "Websocket connections closed by the server.", ("reason",)))
+outbox_jobs = register(Counter(
+    "outbox_jobs_total", "Outbox jobs run, by result: done, retry or failed (out of attempts).", ("kind", "result"),
+))
+
+_caches = {}
+
+
+def register_cache(name, cache):
+    """Expose ``cache.stats()`` of a TTLCache under ``cache="name"``."""
+    _caches[name] = cache
+
+
+def _cache_stat(key):
+    return lambda: {(name, ): cache.stats()[key] for name, cache in _caches.items()}
+
+
+for _key, _doc in (
+        ("size", "Entries held."),
+        ("hits", "Lookups answered from the cache."),
+        ("misses", "Lookups not answered from the cache."),
+        ("evictions", "Entries dropped to stay under maxsize."),
+        ("expirations", "Entries dropped for being older than the ttl."),
+        ("invalidations", "Entries dropped by writes."),
+        ("hit_age_avg", "Average age in seconds of entries served on hits."),
+        ("hit_age_max", "Oldest entry in seconds served on a hit."),
+):
+    register(Gauge("cache_" + _key, _doc, ("cache",), _cache_stat(_key)))
+
+
+_request_queries = ContextVar("request_queries", default=None)
+
+
+def _statement_kind(statement):
+    kind = statement.lstrip()[:6].upper()
+    return kind if kind in ("SELECT", "INSERT", "UPDATE", "DELETE") else "OTHER"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    db_statement_duration.observe(time.perf_counter() - context._metrics_start, _statement_kind(statement))
+    queries = _request_queries.get()
+    if queries is not None:
+        queries[0] += 1
+
+
+def request_queries():
+    """Statement counter of the current request, or None outside of one."""
+    return _request_queries.get()
+
+
+@contextmanager
+def count_queries(queries):
+    """Count the statements run in the block, in whatever task, against ``queries`` from ``request_queries``."""
+    token = _request_queries.set(queries)
+    try:
+        yield
+    finally:
+        _request_queries.reset(token)
+
+
+def instrument_sql():
+    """Time every statement of every engine and count statements per request."""
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and statement count per route template."""
+
+    def __init__(self, app):
+        self.app = app
+        self.routes = None
+
+    def _route(self, scope):
+        route = scope.get("route")
+        if route is not None:
+            return route.path
+        if self.routes is None:
+            self.routes = {
+                r.endpoint: r.path for r in scope["app"].routes if getattr(r, "endpoint", None) is not None
+            }
+        return self.routes.get(scope.get("endpoint"), "<unmatched>")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        queries = [0]
+        token = _request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            _request_queries.reset(token)
+            method, route = scope["method"], self._route(scope)
+            http_requests.inc(method, route, str(status_code))
+            http_request_duration.observe(elapsed, method, route)
+            http_request_queries.observe(queries[0], method, route)
@@ -9,6 +9,11 @@ from enum import Enum
 Base = declarative_base()
 
 
+def normalize_name(name):
+    """Key used to deduplicate reference names: case-folded, whitespace collapsed."""
+    return " ".join(name.split()).casefold()
+
+
 class BaseModel:
 
     def as_dict(self):
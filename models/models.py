@@ -2,13 +2,13 @@
 
 import datetime
 
-from sqlalchemy import Column, DateTime, String, ForeignKey, Float, Boolean, Table
+from sqlalchemy import Column, DateTime, String, Text, ForeignKey, Float, Boolean, Table, Index
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, validates
 from sqlalchemy.dialects import postgresql
-from sqlalchemy.sql import expression
+from sqlalchemy.sql import expression, table, column
 
-from .base import Base, BaseModel
+from .base import Base, BaseModel, normalize_name
 
 
 class Users(Base, BaseModel):
@@ -34,6 +34,7 @@ class Subject(Base, BaseModel):
 
     id = Column(postgresql.INTEGER, primary_key=True, autoincrement=True)
     name = Column(String(length=1024), nullable=False)
+    normalized_name = Column(String(length=1024), nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(
         DateTime(timezone=True),
@@ -42,14 +43,23 @@ class Subject(Base, BaseModel):
         nullable=False
     )
 
+    __table_args__ = (
+        Index("uq_subjects_normalized_name", "normalized_name", unique=True),
+    )
     __mapper_args__ = {"eager_defaults": True}
 
+    @validates("name")
+    def _set_normalized_name(self, key, name):
+        self.normalized_name = normalize_name(name)
+        return name
+
 
 class City(Base, BaseModel):
     __tablename__ = "cities"
 
     id = Column(postgresql.INTEGER, primary_key=True, autoincrement=True)
     name = Column(String(length=1024), nullable=False)
+    normalized_name = Column(String(length=1024), nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(
         DateTime(timezone=True),
@@ -58,8 +68,16 @@ class City(Base, BaseModel):
         nullable=False
     )
 
+    __table_args__ = (
+        Index("uq_cities_normalized_name", "normalized_name", unique=True),
+    )
     __mapper_args__ = {"eager_defaults": True}
 
+    @validates("name")
+    def _set_normalized_name(self, key, name):
+        self.normalized_name = normalize_name(name)
+        return name
+
 
 class Event(Base, BaseModel):
     __tablename__ = "events"
@@ -80,6 +98,10 @@ class Event(Base, BaseModel):
         nullable=False
     )
 
+    __table_args__ = (
+        Index("ix_events_city_start_time", "city", "start_time"),
+        Index("ix_events_start_time_end_time", "start_time", "end_time"),
+    )
     __mapper_args__ = {"eager_defaults": True}
 
 
@@ -99,6 +121,11 @@ class EventSubject(Base, BaseModel):
         nullable=False
     )
 
+    __table_args__ = (
+        Index("uq_events_subjects_event_subject", "event", "subject", unique=True),
+        Index("ix_events_subjects_subject_event", "subject", "event"),
+    )
+
 
 class UserFilter(Base, BaseModel):
     __tablename__ = "user_filters"
@@ -118,6 +145,9 @@ class UserFilter(Base, BaseModel):
         nullable=False
     )
 
+    __table_args__ = (
+        Index("ix_user_filters_user_id", "user_id"),
+    )
     __mapper_args__ = {"eager_defaults": True}
 
 
@@ -136,3 +166,55 @@ class FilterSubject(Base, BaseModel):
         onupdate=func.now(),
         nullable=False
     )
+
+    __table_args__ = (
+        Index("ix_filters_subjects_filter_subject", "filter", "subject"),
+    )
+
+
+# append-only feed of committed changes every worker polls to keep its caches
+# coherent; id is the version, AUTOINCREMENT so pruned ids are never reused
+class ChangeLog(Base, BaseModel):
+    __tablename__ = "change_log"
+
+    id = Column(postgresql.INTEGER, primary_key=True, autoincrement=True)
+    kind = Column(String(length=32), nullable=False)
+    ref_id = Column(postgresql.INTEGER, nullable=True)
+    data = Column(Text, nullable=True)
+    origin = Column(String(length=32), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_change_log_created_at", "created_at"),
+        {"sqlite_autoincrement": True},
+    )
+
+
+# jobs for post-commit work, written in the writer's transaction and run by outbox.OutboxWorker;
+# available_at is when a job may next be claimed, NULL once it has given up, and owner the
+# change_feed.ORIGIN of the process that leased it last
+class Outbox(Base, BaseModel):
+    __tablename__ = "outbox"
+
+    id = Column(postgresql.INTEGER, primary_key=True, autoincrement=True)
+    kind = Column(String(length=64), nullable=False)
+    payload = Column(Text, nullable=False)
+    attempts = Column(postgresql.INTEGER, nullable=False, default=0)
+    available_at = Column(DateTime(timezone=True), nullable=True)
+    owner = Column(String(length=32), nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_outbox_available_at", "available_at"),
+    )
+
+
+# FTS5 index over events.name kept in sync by triggers (sqlite only, created
+# by the events_fts revision); not in the metadata so create_all() skips it
+events_fts = table("events_fts", column("rowid"), column("rank"))
+
+# R*Tree over epoch start/end of events (missing bounds stored as -/+1e12),
+# kept in sync by triggers (sqlite only, created by the events_rtree revision).
+# Coordinates are 32-bit floats rounded outwards, so it only yields candidates.
+events_rtree = table("events_rtree", column("id"), column("start_ts"), column("end_ts"))
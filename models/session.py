@@ -1,17 +1,122 @@
 # coding: utf-8
 
-import os
+import time
 
 from contextlib import asynccontextmanager
 
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 
-from settings import BASEDIR
+from settings import DB_URL, DB_ECHO, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, \
+    DB_POOL_PRE_PING, SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE, \
+    SQLITE_BUSY_TIMEOUT
+from metrics import register, Gauge, db_sessions, db_pool_checkouts, db_pool_checkout_timeouts, \
+    db_pool_checkout_wait
+
+
+DATABASES = {
+    "default": DB_URL,
+}
+
+# per-role overrides of the pool settings; "writer" is the single connection
+# the write queue commits through
+POOLS = {
+    "writer": {"pool_size": 1, "max_overflow": 0},
+}
+
+# applied to every new sqlite connection, None skips a pragma
+SQLITE_PRAGMAS = {
+    "journal_mode": SQLITE_JOURNAL_MODE,
+    "synchronous": SQLITE_SYNCHRONOUS,
+    "mmap_size": SQLITE_MMAP_SIZE,
+    "cache_size": SQLITE_CACHE_SIZE,
+    "busy_timeout": SQLITE_BUSY_TIMEOUT,
+}
+
+
+class _TimedPool(AsyncAdaptedQueuePool):
+    """Queue pool recording how long checkouts wait for a connection."""
+
+    role = "default"
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.role = self.role
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except TimeoutError:
+            db_pool_checkout_timeouts.inc(self.role)
+            raise
+        db_pool_checkout_wait.observe(time.perf_counter() - start, self.role)
+        db_pool_checkouts.inc(self.role)
+        return conn
+
+
+def _setup_sqlite(engine, role):
+    """Apply SQLITE_PRAGMAS and let SQLAlchemy, not the driver, begin transactions.
+
+    The driver's own implicit BEGIN breaks SAVEPOINTs; with it disabled the
+    writer begins with BEGIN IMMEDIATE so it takes the write lock up front
+    instead of failing to upgrade a read transaction.
+    """
+    begin = "BEGIN IMMEDIATE" if role == "writer" else "BEGIN"
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            if value is not None:
+                cursor.execute("PRAGMA {}={}".format(name, value))
+        cursor.close()
+
+    @event.listens_for(engine.sync_engine, "begin")
+    def do_begin(conn):
+        conn.exec_driver_sql(begin)
+
+
+def get_engine(role="default"):
+    """Return the process-wide engine for ``role``, creating it on first use."""
+    url = DATABASES.get(role, DATABASES["default"])
+    key = (role, url)
+    engine = _RoutingSession.engine_pool.get(key)
+    if engine is None:
+        options = dict(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+        )
+        options.update(POOLS.get(role, {}))
+        engine = create_async_engine(url, echo=DB_ECHO, poolclass=_TimedPool, **options)
+        if engine.dialect.name == "sqlite":
+            _setup_sqlite(engine, role)
+        engine.pool.role = role
+        _RoutingSession.engine_pool[key] = engine
+    return engine
+
+
+async def dispose_engines():
+    for engine in list(_RoutingSession.engine_pool.values()):
+        await engine.dispose()
+    _RoutingSession.engine_pool.clear()
+
 
 class _RoutingSession(AsyncSession):
-    """This class """
+    """Async session bound to a cached engine picked by ``role``.
+
+    Engines (and their connection pools) live in ``engine_pool`` for the
+    whole process, so opening a session only checks out a pooled connection.
+    """
 
     engine_pool = {}
 
@@ -20,18 +125,27 @@ class _RoutingSession(AsyncSession):
         super().__init__(bind=bind)
 
     def setup_bind(self, kwargs):
-        return create_async_engine(
-            'sqlite+aiosqlite:///{}'.format(os.path.join(BASEDIR, 'db.sqlite3')),
-            echo=True)
+        return get_engine(kwargs.get("role") or "default")
 
 
 _Session = sessionmaker(class_=_RoutingSession)
 
+
+def _pool_stat(stat):
+    return lambda: {(role,): getattr(engine.pool, stat)() for (role, url), engine in _RoutingSession.engine_pool.items()}
+
+
+register(Gauge("db_pool_size", "Configured pool size.", ("role",), _pool_stat("size")))
+register(Gauge("db_pool_checked_out", "Connections currently checked out.", ("role",), _pool_stat("checkedout")))
+register(Gauge("db_pool_overflow", "Connections open beyond the pool size.", ("role",), _pool_stat("overflow")))
+
+
 @asynccontextmanager
-async def get_session():
+async def get_session(role="default"):
     session = None
     try:
-        session = _Session()
+        session = _Session(role=role)
+        db_sessions.inc()
         yield session
     finally:
         if session is not None:
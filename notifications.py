@@ -0,0 +1,256 @@
+# coding: utf-8
+
+import asyncio
+import datetime
+import itertools
+import json
+import time
+
+from collections import deque
+
+from fastapi import status
+
+from settings import WS_SHARDS, WS_SEND_QUEUE_SIZE, WS_SEND_TIMEOUT, WS_PING_INTERVAL, WS_PING_TIMEOUT
+
+from filter_index import filter_index
+from change_feed import change_feed
+from outbox import outbox
+from metrics import register, Gauge, ws_messages, ws_messages_dropped, ws_frames, ws_closed
+
+
+PING = json.dumps({"type": "ping"})
+
+
+class Connection:
+    """One open websocket, the messages waiting to be sent to it and the frame being sent."""
+
+    __slots__ = ("user_id", "websocket", "shard", "queue", "last_seen", "pinged", "sending", "sending_since", "closed")
+
+    def __init__(self, user_id, websocket, shard, queue_size):
+        self.user_id = user_id
+        self.websocket = websocket
+        self.shard = shard
+        self.queue = deque(maxlen=queue_size)
+        self.last_seen = self.pinged = time.monotonic()
+        self.sending = None
+        self.sending_since = None
+        self.closed = False
+
+
+class _Shard:
+    __slots__ = ("connections", "ready", "wake", "task")
+
+    def __init__(self):
+        self.connections = set()
+        self.ready = set()
+        self.wake = asyncio.Event()
+        self.task = None
+
+
+class ConnectionManager:
+    """Open ``/ws/{id}`` websockets grouped by user id.
+
+    ``send`` never waits on a socket: it encodes the message once and
+    appends it to each connection's queue of ``queue_size`` messages,
+    dropping the oldest one when a client falls that far behind. The
+    connections are spread over ``shards`` tasks. A shard sends everything
+    queued for a connection as one frame (a ``{"type": "batch"}`` frame
+    when several messages piled up) and keeps at most one frame in flight
+    per connection, so messages that arrive meanwhile are coalesced into
+    the next one.
+
+    Each shard also sweeps its connections: a send still pending after
+    ``send_timeout`` seconds closes the connection, a client not heard from
+    for ``ping_interval`` seconds is pinged (whether or not messages are
+    flowing to it) and one silent for ``ping_timeout`` is closed. Any
+    message from the client, e.g. a ``pong``, counts as a sign of life.
+    """
+
+    def __init__(self, shards=WS_SHARDS, queue_size=WS_SEND_QUEUE_SIZE, send_timeout=WS_SEND_TIMEOUT,
+                 ping_interval=WS_PING_INTERVAL, ping_timeout=WS_PING_TIMEOUT):
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.shards = [_Shard() for _ in range(shards)]
+        self._next_shard = itertools.cycle(self.shards)
+        self.connections = {}
+
+    def __len__(self):
+        return sum(len(shard.connections) for shard in self.shards)
+
+    async def start(self):
+        for i, shard in enumerate(self.shards):
+            shard.wake = asyncio.Event()
+            shard.task = asyncio.create_task(self._run(shard, (i + 1) / len(self.shards)))
+
+    async def stop(self):
+        """Stop the shard tasks and close every connection."""
+        for shard in self.shards:
+            if shard.task is not None:
+                shard.task.cancel()
+                try:
+                    await shard.task
+                except asyncio.CancelledError:
+                    pass
+                shard.task = None
+        for shard in self.shards:
+            await asyncio.gather(*[
+                self.close(conn, "shutdown", status.WS_1001_GOING_AWAY) for conn in list(shard.connections)
+            ])
+
+    def connect(self, user_id, websocket):
+        conn = Connection(user_id, websocket, next(self._next_shard), self.queue_size)
+        self.connections.setdefault(user_id, set()).add(conn)
+        conn.shard.connections.add(conn)
+        return conn
+
+    def disconnect(self, conn):
+        conn.closed = True
+        conn.queue.clear()
+        conn.shard.connections.discard(conn)
+        conn.shard.ready.discard(conn)
+        conns = self.connections.get(conn.user_id)
+        if conns is not None:
+            conns.discard(conn)
+            if not conns:
+                del self.connections[conn.user_id]
+
+    async def close(self, conn, reason, code=status.WS_1011_INTERNAL_ERROR):
+        if conn.closed:
+            return
+        self.disconnect(conn)
+        ws_closed.inc(reason)
+        if conn.sending is not None:
+            conn.sending.cancel()
+        try:
+            await asyncio.wait_for(conn.websocket.close(code=code), self.send_timeout)
+        except Exception:
+            pass
+
+    async def serve(self, user_id, websocket):
+        """Register an accepted websocket and read from it until the client goes away."""
+        conn = self.connect(user_id, websocket)
+        try:
+            while not conn.closed:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                conn.last_seen = time.monotonic()
+        finally:
+            self.disconnect(conn)
+
+    def send(self, user_ids, message):
+        data = json.dumps(message)
+        queued = dropped = 0
+        for user_id in user_ids:
+            for conn in self.connections.get(user_id, ()):
+                dropped += len(conn.queue) == self.queue_size
+                self._enqueue(conn, data)
+                queued += 1
+        ws_messages.inc(amount=queued)
+        if dropped:
+            ws_messages_dropped.inc(amount=dropped)
+
+    @staticmethod
+    def _enqueue(conn, data):
+        conn.queue.append(data)
+        if conn.sending is None:
+            conn.shard.ready.add(conn)
+            conn.shard.wake.set()
+
+    def _flush(self, conn, now):
+        queue = conn.queue
+        frame = queue[0] if len(queue) == 1 else '{"type": "batch", "messages": [' + ", ".join(queue) + ']}'
+        queue.clear()
+        conn.sending_since = now
+        conn.sending = asyncio.create_task(self._send(conn, frame))
+
+    async def _send(self, conn, frame):
+        try:
+            await conn.websocket.send_text(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            conn.sending = None
+            await self.close(conn, "send_failed")
+            return
+        ws_frames.inc()
+        conn.sending = None
+        if conn.queue and not conn.closed:
+            conn.shard.ready.add(conn)
+            conn.shard.wake.set()
+
+    def _sweep(self, shard, now):
+        """Queue pings for quiet connections and return the ones to close with the reason."""
+        res = []
+        for conn in shard.connections:
+            if conn.sending is not None and now - conn.sending_since >= self.send_timeout:
+                res.append((conn, "send_timeout"))
+            elif now - conn.last_seen >= self.ping_timeout:
+                res.append((conn, "ping_timeout"))
+            elif now - conn.last_seen >= self.ping_interval and now - conn.pinged >= self.ping_interval:
+                conn.pinged = now
+                self._enqueue(conn, PING)
+        return res
+
+    async def _run(self, shard, offset):
+        # shards sweep at staggered times so pings do not all go out at once
+        period = min(self.ping_interval, self.send_timeout)
+        next_sweep = time.monotonic() + period * offset
+        loop = asyncio.get_running_loop()
+        while True:
+            # not wait_for(), which can swallow the cancellation stop() sends
+            timer = loop.call_later(max(0, next_sweep - time.monotonic()), shard.wake.set)
+            try:
+                await shard.wake.wait()
+            finally:
+                timer.cancel()
+            shard.wake.clear()
+            now = time.monotonic()
+            if shard.ready:
+                ready, shard.ready = shard.ready, set()
+                for conn in ready:
+                    if conn.queue and conn.sending is None and not conn.closed:
+                        self._flush(conn, now)
+            if now >= next_sweep:
+                await asyncio.gather(*[
+                    self.close(conn, reason, status.WS_1001_GOING_AWAY) for conn, reason in self._sweep(shard, now)
+                ])
+                next_sweep = now + period
+
+
+manager = ConnectionManager()
+
+register(Gauge("ws_connections", "Open websocket connections.", (), lambda: {(): len(manager)}))
+
+
+async def notify_event(event, city, start_time, end_time, subject_ids):
+    """Queue ``event`` for every user connected to this worker with a saved filter matching it."""
+    if not manager.connections:
+        return
+    user_ids = filter_index.match_users(city, start_time, end_time, subject_ids)
+    manager.send(user_ids & manager.connections.keys(), {"type": "event", "event": event})
+
+
+def _parse_time(value):
+    return datetime.datetime.fromisoformat(value) if value is not None else None
+
+
+async def _notify_event_job(payload):
+    await notify_event(
+        payload["event"], payload["city"], _parse_time(payload["start_time"]), _parse_time(payload["end_time"]),
+        payload["subjects"],
+    )
+
+
+async def _apply_notify_changes(session, changes):
+    for event_id, data in changes:
+        await _notify_event_job(data)
+
+
+# The worker that wrote an event runs its outbox job; every other worker
+# holds its own sockets and reads the same payload from the change log.
+# Notifications pruned before a worker read them are not delivered there.
+outbox.register("notify_event", _notify_event_job)
+change_feed.subscribe("notify_event", _apply_notify_changes)
@@ -0,0 +1,248 @@
+# coding: utf-8
+
+import asyncio
+import datetime
+import json
+import random
+import time
+
+from sqlalchemy import delete, event, update
+from sqlalchemy.future import select
+from sqlalchemy.orm import Session
+
+from settings import OUTBOX_WORKERS, OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_LEASE, OUTBOX_MAX_ATTEMPTS, \
+    OUTBOX_RETRY_DELAY, OUTBOX_RETRY_MAX_DELAY
+
+from models.session import get_session
+from models.models import Outbox
+from change_feed import ORIGIN
+from metrics import outbox_jobs
+from write_queue import write_queue
+
+
+def enqueue(session, kind, payload):
+    """Add a job for the ``kind`` handler; it only runs if the session's transaction commits.
+
+    The job comes already leased to this process, which runs it right after
+    the commit; other processes only claim it once the lease runs out.
+    """
+    session.add(Outbox(
+        kind=kind, payload=json.dumps(payload), attempts=1, owner=ORIGIN,
+        available_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=outbox.lease),
+    ))
+
+
+class OutboxWorker:
+    """Runs the jobs of the ``outbox`` table with registered handlers.
+
+    A dispatcher task hands jobs to ``workers`` tasks that run the handlers
+    concurrently. Jobs enqueued by this process are read back and run as
+    soon as their transaction commits. Every ``poll_interval`` seconds the
+    dispatcher also claims up to ``batch_size`` due jobs (retries, and jobs
+    left behind by a process that died), leasing them for ``lease`` seconds,
+    and in the same transaction deletes the finished jobs and reschedules
+    the failed ones with exponential backoff. Results are thus written in
+    batches and an enqueued job costs the write path a single insert.
+
+    A job whose result was not recorded before its lease ran out is run
+    again, so delivery is at least once, in no particular order, and
+    handlers must be idempotent. Jobs still failing after ``max_attempts``
+    stay in the table with ``available_at`` cleared and their last error.
+    """
+
+    def __init__(self, workers=OUTBOX_WORKERS, batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_INTERVAL,
+                 lease=OUTBOX_LEASE, max_attempts=OUTBOX_MAX_ATTEMPTS, retry_delay=OUTBOX_RETRY_DELAY,
+                 retry_max_delay=OUTBOX_RETRY_MAX_DELAY):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.handlers = {}
+        self.dispatcher = None
+        self.tasks = []
+        self.queue = None
+        # ids of jobs committed by this process and not run yet
+        self.committed = set()
+        self.results = []
+        self.stopping = False
+        self.event = None
+
+    def register(self, kind, handler):
+        """``handler(payload)`` is a coroutine function; raising makes the job retry."""
+        self.handlers[kind] = handler
+
+    def run_committed(self, ids):
+        if self.event is not None:
+            self.committed.update(ids)
+            self.event.set()
+
+    async def start(self):
+        self.stopping = False
+        self.event = asyncio.Event()
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self.dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self):
+        """Finish the jobs at hand and record the results, cancelling them after ``lease`` seconds."""
+        if self.dispatcher is None:
+            return
+        self.stopping = True
+        self.event.set()
+        done, pending = await asyncio.wait([self.dispatcher], timeout=self.lease)
+        for task in list(pending) + self.tasks:
+            task.cancel()
+        await asyncio.gather(self.dispatcher, *self.tasks, return_exceptions=True)
+        self.dispatcher = self.queue = self.event = None
+        self.tasks = []
+        self.committed.clear()
+
+    def _backoff(self, attempts):
+        delay = min(self.retry_max_delay, self.retry_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1)
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        next_poll = time.monotonic() + self.poll_interval
+        while True:
+            self.event.clear()
+            jobs = None
+            try:
+                if self.stopping or time.monotonic() >= next_poll or len(self.results) >= self.batch_size:
+                    results, self.results = self.results, []
+                    jobs = await self._ack_and_claim(results, claim=not self.stopping)
+                    # claim again right away while there is a backlog
+                    next_poll = time.monotonic() + (0 if jobs else self.poll_interval)
+                elif self.committed:
+                    jobs = await self._load_committed()
+            except Exception as e:
+                print("outbox dispatch failed: {}".format(e))
+            if self.stopping:
+                return
+            if jobs:
+                for job in jobs:
+                    self.queue.put_nowait(job)
+                await self.queue.join()
+                continue
+            if self.committed:
+                continue
+            # not wait_for(), which can swallow the cancellation stop() sends
+            timer = loop.call_later(max(0, next_poll - time.monotonic()), self.event.set)
+            try:
+                await self.event.wait()
+            finally:
+                timer.cancel()
+
+    async def _work(self):
+        while True:
+            job_id, kind, payload, attempts = await self.queue.get()
+            handler = self.handlers.get(kind)
+            try:
+                if handler is None:
+                    raise LookupError("no handler for {!r}".format(kind))
+                await handler(json.loads(payload))
+            except Exception as e:
+                self.results.append((job_id, kind, attempts, repr(e)))
+            else:
+                self.results.append((job_id, kind, attempts, None))
+            finally:
+                self.queue.task_done()
+
+    async def _load_committed(self):
+        """Read back the jobs this process committed; rolled back ones are not found."""
+        ids, self.committed = list(self.committed), set()
+        async with get_session() as s:
+            return (await s.execute(
+                select(Outbox.id, Outbox.kind, Outbox.payload, Outbox.attempts)
+                .filter(Outbox.id.in_(ids), Outbox.owner == ORIGIN)
+            )).fetchall()
+
+    async def _ack_and_claim(self, results, claim=True):
+        """Record the ``results`` of finished jobs and lease up to ``batch_size`` due ones.
+
+        Returns the (id, kind, payload, attempts) of the claimed jobs.
+        """
+        now = datetime.datetime.utcnow()
+        if not results:
+            if not claim:
+                return []
+            # a plain read first, so an idle dispatcher does not take the write lock
+            async with get_session() as s:
+                due = (await s.execute(select(Outbox.id).filter(Outbox.available_at <= now).limit(1))).scalar()
+            if due is None:
+                return []
+
+        async def write(s):
+            done = [job_id for job_id, kind, attempts, error in results if error is None]
+            if done:
+                await s.execute(
+                    delete(Outbox).where(Outbox.id.in_(done)).execution_options(synchronize_session=False)
+                )
+            for job_id, kind, attempts, error in results:
+                if error is not None:
+                    retry = attempts < self.max_attempts
+                    await s.execute(
+                        update(Outbox)
+                        .where(Outbox.id == job_id)
+                        .values(
+                            available_at=now + datetime.timedelta(seconds=self._backoff(attempts)) if retry else None,
+                            last_error=error[:1024],
+                        )
+                        .execution_options(synchronize_session=False)
+                    )
+            if not claim:
+                return []
+            ids = (await s.execute(
+                select(Outbox.id)
+                .filter(Outbox.available_at <= now)
+                .order_by(Outbox.id)
+                .limit(self.batch_size)
+            )).scalars().all()
+            if not ids:
+                return []
+            await s.execute(
+                update(Outbox)
+                .where(Outbox.id.in_(ids))
+                .values(
+                    available_at=now + datetime.timedelta(seconds=self.lease), attempts=Outbox.attempts + 1,
+                    owner=ORIGIN,
+                )
+                .execution_options(synchronize_session=False)
+            )
+            return (await s.execute(
+                select(Outbox.id, Outbox.kind, Outbox.payload, Outbox.attempts)
+                .filter(Outbox.id.in_(ids))
+            )).fetchall()
+
+        jobs = await write_queue.submit(write)
+        for job_id, kind, attempts, error in results:
+            if error is None:
+                outbox_jobs.inc(kind, "done")
+            else:
+                outbox_jobs.inc(kind, "retry" if attempts < self.max_attempts else "failed")
+        return jobs
+
+
+outbox = OutboxWorker()
+
+
+@event.listens_for(Outbox, "after_insert")
+def _track_outbox_insert(mapper, connection, target):
+    # not cleared on rollback: a savepoint rollback would drop the other jobs
+    # of a group commit, and the ids of rolled back rows simply are not found
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault("outbox", []).append(target.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _run_committed_outbox(session):
+    if session.in_nested_transaction():
+        # released savepoint, the jobs are not visible until the outer commit
+        return
+    ids = session.info.pop("outbox", None)
+    if ids:
+        outbox.run_committed(ids)
@@ -0,0 +1,118 @@
+# coding: utf-8
+
+import asyncio
+
+from sqlalchemy import or_
+from sqlalchemy.future import select
+
+from settings import REFERENCE_REFRESH_INTERVAL
+
+from models.base import normalize_name
+from models.session import get_session
+from models.models import City, Subject
+
+
+class ReferenceCache:
+    """Process-local copy of a small reference table (cities, subjects).
+
+    Holds id -> (name, normalized name) and normalized name -> id. Only
+    committed rows are added: at load, by ``refresh`` and by writers after
+    their commit. ``refresh`` re-reads the rows updated since the newest
+    ``updated_at`` seen, plus any ids asked for that are not known yet
+    (a row committed late can carry an ``updated_at`` below the watermark).
+    """
+
+    def __init__(self, db_model):
+        self.db_model = db_model
+        self.by_id = {}
+        self.by_name = {}
+        self.watermark = None
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def add(self, rec_id, name, normalized_name):
+        old = self.by_id.get(rec_id)
+        if old is not None and old[1] != normalized_name:
+            self.by_name.pop(old[1], None)
+        self.by_id[rec_id] = (name, normalized_name)
+        self.by_name[normalized_name] = rec_id
+
+    def lookup(self, request):
+        """(id, name, normalized name) for a City/Subject request, None when not cached."""
+        if request.id:
+            rec = self.by_id.get(request.id)
+            return (request.id, ) + rec if rec is not None else None
+        if request.name:
+            rec_id = self.by_name.get(normalize_name(request.name))
+            return (rec_id, ) + self.by_id[rec_id] if rec_id is not None else None
+        return None
+
+    def remember(self, refs):
+        """Add the rows a committed ``resolve_references`` call read from the database."""
+        for row in refs.loaded:
+            self.add(*row)
+
+    def name(self, rec_id):
+        rec = self.by_id.get(rec_id)
+        return rec[0] if rec is not None else None
+
+    async def names(self, session, ids):
+        """Names of ``ids``, refreshing once from the database when some are missing."""
+        missing = {i for i in ids if i is not None and i not in self.by_id}
+        if missing:
+            await self.refresh(session, missing)
+        return {i: self.name(i) for i in ids}
+
+    async def refresh(self, session, ids=()):
+        model = self.db_model
+        query = select(model.id, model.name, model.normalized_name, model.updated_at)
+        if self.watermark is not None:
+            # updated_at has second resolution, re-read the newest second
+            condition = model.updated_at >= self.watermark
+            query = query.filter(or_(condition, model.id.in_(ids)) if ids else condition)
+        for rec_id, name, normalized_name, updated_at in (await session.execute(query)).fetchall():
+            self.add(rec_id, name, normalized_name)
+            if self.watermark is None or updated_at > self.watermark:
+                self.watermark = updated_at
+
+
+city_cache = ReferenceCache(City)
+subject_cache = ReferenceCache(Subject)
+reference_caches = {City: city_cache, Subject: subject_cache}
+
+_refresh_task = None
+
+
+async def load_references():
+    async with get_session() as s:
+        for cache in reference_caches.values():
+            await cache.refresh(s)
+
+
+async def _refresh_forever(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await load_references()
+        except Exception as e:
+            print("reference refresh failed: {}".format(e))
+
+
+async def start_reference_refresh(interval=REFERENCE_REFRESH_INTERVAL):
+    """Load the reference caches and keep refreshing them every ``interval`` seconds."""
+    global _refresh_task
+    await load_references()
+    if interval:
+        _refresh_task = asyncio.create_task(_refresh_forever(interval))
+
+
+async def stop_reference_refresh():
+    global _refresh_task
+    if _refresh_task is not None:
+        _refresh_task.cancel()
+        try:
+            await _refresh_task
+        except asyncio.CancelledError:
+            pass
+        _refresh_task = None
@@ -0,0 +1,73 @@
+# coding: utf-8
+
+import hashlib
+
+from sqlalchemy.sql.sqltypes import DateTime
+
+from fastapi import status
+from fastapi.responses import JSONResponse, Response
+
+try:
+    from fastapi.responses import ORJSONResponse
+    import orjson  # noqa: F401
+except ImportError:
+    ORJSONResponse = None
+
+
+ListResponse = ORJSONResponse or JSONResponse
+
+
+def compile_serializer(columns, response_model):
+    """Build a function turning a result row of ``columns`` into a response dict.
+
+    The function is generated once, with one fixed index lookup per column and
+    ``isoformat()`` only for DateTime columns, so rows coming from the database
+    are not walked or re-validated per request. Every column key must be a field
+    of ``response_model``.
+    """
+    items = []
+    for i, column in enumerate(columns):
+        if column.key not in response_model.__fields__:
+            raise ValueError("{} has no field {!r}".format(response_model.__name__, column.key))
+        if isinstance(column.type, DateTime):
+            value = "(r[{0}].isoformat() if r[{0}] is not None else None)".format(i)
+        else:
+            value = "r[{}]".format(i)
+        items.append("{!r}: {}".format(column.key, value))
+    return eval("lambda r: {{{}}}".format(", ".join(items)))
+
+
+def list_response(content, response):
+    """Render ``content`` without FastAPI's validation, keeping headers set on ``response``."""
+    res = ListResponse(content)
+    for key, value in response.headers.items():
+        res.headers[key] = value
+    return res
+
+
+def make_etag(*parts):
+    """Weak ETag for a response identified by ``parts`` (request parameters and data watermarks)."""
+    return 'W/"{}"'.format(hashlib.sha1(repr(parts).encode("utf-8")).hexdigest())
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match header against ``etag``."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tag = etag[2:] if etag.startswith("W/") else etag
+    for value in if_none_match.split(","):
+        value = value.strip()
+        if (value[2:] if value.startswith("W/") else value) == tag:
+            return True
+    return False
+
+
+def not_modified(etag, response):
+    """Empty 304 response for ``etag``, keeping headers set on ``response``."""
+    res = Response(status_code=status.HTTP_304_NOT_MODIFIED)
+    for key, value in response.headers.items():
+        res.headers[key] = value
+    res.headers["ETag"] = etag
+    return res
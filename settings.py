@@ -9,3 +9,68 @@ ACCESS_TOKEN_LIFETIME = 24*60*60
 REFRESH_TOKEN_LIFETIME = 24*60*60*60
 
 BASEDIR = os.path.dirname(os.path.abspath(__file__))
+
+DB_URL = os.getenv('DB_URL', 'sqlite+aiosqlite:///{}'.format(os.path.join(BASEDIR, 'db.sqlite3')))
+DB_ECHO = os.getenv('DB_ECHO', '0') == '1'
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 3600))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', '1') == '1'
+
+PRINCIPAL_CACHE_SIZE = int(os.getenv('PRINCIPAL_CACHE_SIZE', 10000))
+PRINCIPAL_CACHE_TTL = int(os.getenv('PRINCIPAL_CACHE_TTL', 60))
+
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 500))
+BULK_MAX_LINE_SIZE = int(os.getenv('BULK_MAX_LINE_SIZE', 64*1024))
+BULK_RESULTS_SPOOL_SIZE = int(os.getenv('BULK_RESULTS_SPOOL_SIZE', 1024*1024))
+
+FILTER_INDEX_BUCKET_SIZE = int(os.getenv('FILTER_INDEX_BUCKET_SIZE', 24*60*60))
+FILTER_INDEX_MAX_BUCKETS = int(os.getenv('FILTER_INDEX_MAX_BUCKETS', 64))
+
+PASSWORD_HASHER = os.getenv('PASSWORD_HASHER', 'scrypt')
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 4))
+PASSWORD_HASH_CONCURRENCY = int(os.getenv('PASSWORD_HASH_CONCURRENCY', 16))
+PASSWORD_REHASH_ON_LOGIN = os.getenv('PASSWORD_REHASH_ON_LOGIN', '0') == '1'
+PBKDF2_ITERATIONS = int(os.getenv('PBKDF2_ITERATIONS', 260000))
+SCRYPT_N = int(os.getenv('SCRYPT_N', 2**14))
+SCRYPT_R = int(os.getenv('SCRYPT_R', 8))
+SCRYPT_P = int(os.getenv('SCRYPT_P', 1))
+
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 1000))
+
+EVENTS_CACHE_SIZE = int(os.getenv('EVENTS_CACHE_SIZE', 1024))
+EVENTS_CACHE_TTL = int(os.getenv('EVENTS_CACHE_TTL', 300))
+
+GZIP_MINIMUM_SIZE = int(os.getenv('GZIP_MINIMUM_SIZE', 1000))
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256*1024*1024))
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', -64*1024))
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))
+
+WRITE_QUEUE_SIZE = int(os.getenv('WRITE_QUEUE_SIZE', 1000))
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 64))
+
+REFERENCE_REFRESH_INTERVAL = int(os.getenv('REFERENCE_REFRESH_INTERVAL', 60))
+
+CHANGE_FEED_POLL_INTERVAL = float(os.getenv('CHANGE_FEED_POLL_INTERVAL', 0.5))
+CHANGE_FEED_BATCH_SIZE = int(os.getenv('CHANGE_FEED_BATCH_SIZE', 1000))
+CHANGE_LOG_RETENTION = int(os.getenv('CHANGE_LOG_RETENTION', 60*60))
+
+WS_SHARDS = int(os.getenv('WS_SHARDS', 16))
+WS_SEND_QUEUE_SIZE = int(os.getenv('WS_SEND_QUEUE_SIZE', 64))
+WS_SEND_TIMEOUT = float(os.getenv('WS_SEND_TIMEOUT', 10))
+WS_PING_INTERVAL = float(os.getenv('WS_PING_INTERVAL', 30))
+WS_PING_TIMEOUT = float(os.getenv('WS_PING_TIMEOUT', 75))
+
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 4))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 100))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 1))
+OUTBOX_LEASE = int(os.getenv('OUTBOX_LEASE', 60))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 10))
+OUTBOX_RETRY_DELAY = float(os.getenv('OUTBOX_RETRY_DELAY', 1))
+OUTBOX_RETRY_MAX_DELAY = float(os.getenv('OUTBOX_RETRY_MAX_DELAY', 300))
@@ -9,6 +9,7 @@ from typing import Optional, List, Any
 
 from fastapi import APIRouter, status, Response, Header
 
+from sqlalchemy import update
 from sqlalchemy.future import select
 
 from response_models import Error40xResponse
@@ -19,8 +20,11 @@ from .response_models import AuthResponse, AccountInfo, RegisterResponse
 from models.session import get_session
 from models.models import Users
 
-from base_obj import password_hash, check_token, check_auth
-from settings import ACCESS_TOKEN_LIFETIME, REFRESH_TOKEN_LIFETIME, SERVER_SECRET
+from base_obj import password_hash, check_password, check_token, check_auth, invalidate_principal
+from change_feed import log_change
+from serializers import make_etag, etag_matches, not_modified
+from write_queue import write_queue
+from settings import ACCESS_TOKEN_LIFETIME, REFRESH_TOKEN_LIFETIME, SERVER_SECRET, PASSWORD_REHASH_ON_LOGIN
 
 
 router = APIRouter(
@@ -29,6 +33,40 @@ router = APIRouter(
 )
 
 
+async def _rehash_password(user, password):
+    """Store ``password`` hashed with the default scheme for ``user`` and return the hash in effect.
+
+    The update only applies while the stored hash is still the one just
+    verified; if it cannot be written the login goes on with the old one.
+
+    Tokens carry the stored hash, so a rehash signs the user out of every
+    other session. Logins therefore only upgrade legacy hashes when
+    PASSWORD_REHASH_ON_LOGIN is set.
+    """
+    encoded = await password_hash(password=password, salt=user.salt)
+
+    async def write(s):
+        result = await s.execute(
+            update(Users)
+            .where(Users.id == user.id, Users.password == user.password)
+            .values(password=encoded)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount:
+            log_change(s, "user", user.id)
+        return result.rowcount
+
+    try:
+        updated = await write_queue.submit(write)
+    except Exception as e:
+        print("password rehash failed: {}".format(e))
+        return user.password
+    if not updated:
+        return user.password
+    invalidate_principal(user.id)
+    return encoded
+
+
 @router.post(
     "",
     responses={
@@ -49,38 +87,42 @@ async def auth_method(
     async with get_session() as s:
         user = await s.execute(select(Users).filter(Users.username == auth.username))
         user = user.scalars().first()  #type: Users
-        if not user:
-            response.status_code = status.HTTP_401_UNAUTHORIZED
-            return Error40xResponse.parse_obj({"reason": "wrong credentials"})
-        if user and auth.password and user.password == password_hash(password=auth.password, salt=user.salt):
-            access_token_exp_date = datetime.datetime.now().timestamp() + ACCESS_TOKEN_LIFETIME
-            refresh_token_exp_date = datetime.datetime.now().timestamp() + REFRESH_TOKEN_LIFETIME
-            access_token = jwt.encode(
-                {
-                    'user_id': user.id,
-                    'username': user.username,
-                    'password': user.password,
-                    'expiration_time': access_token_exp_date,
-                },
-                SERVER_SECRET,
-                algorithm='HS256'
-            )
-            refresh_token = jwt.encode(
-                {
-                    'user_id': user.id,
-                    'username': user.username,
-                    'password': user.password,
-                    'expiration_time': refresh_token_exp_date,
-                },
-                SERVER_SECRET,
-                algorithm='HS256'
-            )
-            return AuthResponse.parse_obj(
-                {
-                    "access_token": access_token,
-                    "refresh_token": refresh_token,
-                }
-            )
+    if not user:
+        response.status_code = status.HTTP_401_UNAUTHORIZED
+        return Error40xResponse.parse_obj({"reason": "wrong credentials"})
+    valid, rehash = await check_password(auth.password, user.salt, user.password) \
+        if auth.password else (False, False)
+    if valid:
+        password = await _rehash_password(user, auth.password) \
+            if rehash and PASSWORD_REHASH_ON_LOGIN else user.password
+        access_token_exp_date = datetime.datetime.now().timestamp() + ACCESS_TOKEN_LIFETIME
+        refresh_token_exp_date = datetime.datetime.now().timestamp() + REFRESH_TOKEN_LIFETIME
+        access_token = jwt.encode(
+            {
+                'user_id': user.id,
+                'username': user.username,
+                'password': password,
+                'expiration_time': access_token_exp_date,
+            },
+            SERVER_SECRET,
+            algorithm='HS256'
+        )
+        refresh_token = jwt.encode(
+            {
+                'user_id': user.id,
+                'username': user.username,
+                'password': password,
+                'expiration_time': refresh_token_exp_date,
+            },
+            SERVER_SECRET,
+            algorithm='HS256'
+        )
+        return AuthResponse.parse_obj(
+            {
+                "access_token": access_token,
+                "refresh_token": refresh_token,
+            }
+        )
 
     response.status_code = status.HTTP_401_UNAUTHORIZED
     return Error40xResponse.parse_obj({'reason': 'wrong username or password'})
@@ -152,12 +194,19 @@ async def get_user_info(
         authorization: Optional[str] = Header(None),
         status_code=status.HTTP_200_OK,
         user_info=None,
-        etag_request: Optional[str] = None,
+        etag_request: Optional[str] = Header(None, alias="If-None-Match"),
 ) -> dict:
-    user_info = user_info.as_dict()
-    user_info.pop("salt")
-    user_info.pop("password")
-    return AccountInfo.parse_obj(user_info)
+    etag = make_etag("account", user_info.id, user_info.username, user_info.updated_at)
+    if etag_matches(etag_request, etag):
+        return not_modified(etag, response)
+    response.headers["ETag"] = etag
+    # as_dict() leaves out the timestamps; users have no type column
+    return AccountInfo.parse_obj({
+        "id": user_info.id,
+        "username": user_info.username,
+        "created_at": user_info.created_at,
+        "updated_at": user_info.updated_at,
+    })
 
 
 @router.post(
@@ -183,17 +232,16 @@ async def register_user(
         status_code: Optional[Any] = status.HTTP_200_OK,
 ) -> dict:
     salt = uuid.uuid4().hex
-    async with get_session() as s:
-        user = Users(
-            username=reg.username,
-            salt=salt,
-            password=password_hash(
-                password=reg.password,
-                salt=salt
-            ),
-        )
-        s.add(user)
-        await s.commit()
+    password = await password_hash(
+        password=reg.password,
+        salt=salt
+    )
+
+    async def write(s):
+        s.add(Users(username=reg.username, salt=salt, password=password))
+        await s.flush()
+
+    await write_queue.submit(write)
     return RegisterResponse.parse_obj(
         {"username": reg.username, "password": reg.password}
     )
@@ -1,27 +1,45 @@
 # coding: utf-8
 
+import calendar
+import csv
 import datetime
+import io
 import jwt
-import dateutil.parser
+import json
+import re
+import tempfile
 import uuid
 
 from typing import Optional, List, Any
 
 from fastapi import APIRouter, status, Response, Header, Request, WebSocket
+from fastapi.responses import StreamingResponse
 
-from pydantic import BaseModel
+from pydantic import ValidationError
 
+from sqlalchemy import func, literal_column, or_
 from sqlalchemy.future import select
 
 from response_models import Error40xResponse
 
-from .request_models import EventRequest, FilterRequest
+from .request_models import EventRequest, EventWriteRequest, FilterRequest
 from .response_models import EventResponse, UserFilterResponse
 
-from models.session import get_session
-from models.models import Users, Event, City, Subject, EventSubject, UserFilter, FilterSubject
+from models.session import get_session, get_engine
+from models.models import Users, Event, City, Subject, EventSubject, UserFilter, FilterSubject, ChangeLog, \
+    events_fts, events_rtree
 
-from base_obj import check_auth, create_update_record
+from base_obj import check_auth, create_update_record, encode_cursor, decode_cursor, parse_datetime, \
+    resolve_references, add_event_subjects, NOT_OWNED, RequiredField
+from filter_index import filter_index
+from write_queue import write_queue, Rollback
+from change_feed import change_feed, log_change
+from outbox import enqueue
+from references import city_cache, subject_cache
+from serializers import compile_serializer, list_response, make_etag, etag_matches, not_modified
+from cache import TTLCache
+from settings import BULK_CHUNK_SIZE, BULK_MAX_LINE_SIZE, BULK_RESULTS_SPOOL_SIZE, EXPORT_CHUNK_SIZE, \
+    EVENTS_CACHE_SIZE, EVENTS_CACHE_TTL
 
 
 router = APIRouter(
@@ -30,16 +48,410 @@ router = APIRouter(
 )
 
 
+# city is the id here, _event_dicts swaps in the name from the reference cache
+_EVENT_COLUMNS = (Event.id, Event.name, Event.start_time, Event.end_time, Event.city)
+_serialize_event = compile_serializer(_EVENT_COLUMNS, EventResponse)
+
+_FILTER_COLUMNS = (UserFilter.id, UserFilter.start_time, UserFilter.end_time, UserFilter.city)
+_serialize_filter = compile_serializer(_FILTER_COLUMNS, UserFilterResponse)
+
+# GET /v1/events pages keyed by (city, start_time, end_time, subjects, limit, page, time_match)
+events_cache = TTLCache(maxsize=EVENTS_CACHE_SIZE, ttl=EVENTS_CACHE_TTL)
+# bumped on every invalidation so a page read before a write is not cached after it
+_events_cache_generation = 0
+
+
+def _events_cache_tags(city, subjects):
+    """One (city, subject) tag per subject a page filters on, None standing for no filter."""
+    return [(city, subject) for subject in subjects or (None,)]
+
+
+def invalidate_events(cities, subjects):
+    """Drop cached event pages that events in ``cities`` with ``subjects`` could appear on."""
+    global _events_cache_generation
+    _events_cache_generation += 1
+    # pages without a city or subject filter are tagged None and always affected
+    subjects = set(subjects) | {None}
+    for city in set(cities) | {None}:
+        for subject in subjects:
+            events_cache.invalidate_tag((city, subject))
+
+
+async def _apply_event_changes(session, changes):
+    cities, subjects = set(), set()
+    for event_id, data in changes:
+        cities.update(data["cities"])
+        subjects.update(data["subjects"])
+    invalidate_events(cities, subjects)
+
+
+async def _reset_events(session):
+    global _events_cache_generation
+    _events_cache_generation += 1
+    events_cache.clear()
+
+
+change_feed.subscribe("events", _apply_event_changes, _reset_events)
+
+
+def _log_event_change(session, event_id, cities, subjects):
+    log_change(
+        session, "events", event_id, cities=sorted(c for c in cities if c is not None), subjects=sorted(subjects),
+    )
+
+
+def _notify_event(session, event, city, start_time, end_time, subject_ids):
+    """Queue the notification of a saved ``event``, an EventResponse dict, in the session's transaction."""
+    notification = {
+        "event": event, "city": city,
+        "start_time": start_time.isoformat() if start_time else None,
+        "end_time": end_time.isoformat() if end_time else None,
+        "subjects": sorted(subject_ids),
+    }
+    # the outbox job reaches this worker's sockets, the change feed the other workers'
+    enqueue(session, "notify_event", notification)
+    log_change(session, "notify_event", event["id"], **notification)
+
+
+def _parse_ids(value):
+    ids = []
+    for i in value.split(','):
+        try:
+            ids.append(int(i))
+        except ValueError:
+            pass
+    return ids
+
+
+TIME_MATCHES = ("exact", "window")
+
+
+def _valid_times(*values):
+    """Whether every value is empty, the -1 sentinel or a time ``parse_datetime`` accepts."""
+    try:
+        for value in values:
+            if value and value != -1 and value != "-1":
+                parse_datetime(value)
+    except ValueError:
+        return False
+    return True
+
+
+def _epoch(value):
+    """Seconds since the epoch of a datetime's wall clock, as the R*Tree stores it."""
+    return calendar.timegm(value.timetuple()) + value.microsecond / 1e6
+
+
+def _events_query(city, start_time, end_time, subjects, time_match="exact"):
+    """Event listing query with the filters shared by ``get_events``, ``search_events`` and ``export_events``.
+
+    With ``time_match="window"`` start_time and end_time bound a window and
+    events overlapping it are returned, a missing bound on either side
+    being unbounded. On sqlite the R*Tree narrows the candidates first.
+    Times must pass ``_valid_times``.
+    """
+    events = select(*_EVENT_COLUMNS)
+    if subjects:
+        events = events.filter(
+            Event.id.in_(
+                select(EventSubject.event)
+                .filter(EventSubject.subject.in_(_parse_ids(subjects)))
+            )
+        )
+    if city:
+        events = events.filter(Event.city == city)
+    start = parse_datetime(start_time) if start_time else None
+    end = parse_datetime(end_time) if end_time else None
+    if time_match == "window":
+        if start is None and end is None:
+            return events
+        if get_engine().dialect.name == "sqlite":
+            candidates = select(events_rtree.c.id)
+            if end is not None:
+                candidates = candidates.filter(events_rtree.c.start_ts <= _epoch(end))
+            if start is not None:
+                candidates = candidates.filter(events_rtree.c.end_ts >= _epoch(start))
+            events = events.filter(Event.id.in_(candidates))
+        if end is not None:
+            events = events.filter(or_(Event.start_time.is_(None), Event.start_time <= end))
+        if start is not None:
+            events = events.filter(or_(Event.end_time.is_(None), Event.end_time >= start))
+        return events
+    if start is not None:
+        events = events.filter(Event.start_time == start)
+    if end is not None:
+        events = events.filter(Event.end_time == end)
+    return events
+
+
+def _fts_match(q):
+    """FTS5 query for ``q``, or None when ``q`` has no words.
+
+    Every word must match; the last one may be incomplete and matches as a
+    prefix. Earlier words are matched exactly, which keeps frequent words
+    from expanding into every token they prefix.
+    """
+    words = ['"{}"'.format(w) for w in re.findall(r"\w+", q)]
+    if not words:
+        return None
+    words[-1] += "*"
+    return " ".join(words)
+
+
+def _events_watermark():
+    """Newest change log id, a version of every event listing.
+
+    Each write that can change a listing (events, their subjects) logs a
+    change in its own transaction, and max(id) is a single rowid lookup.
+    """
+    return select(func.max(ChangeLog.id))
+
+
+async def _export_rows(events, fmt):
+    """Yield the events of ``events`` as NDJSON or CSV, EXPORT_CHUNK_SIZE rows at a time."""
+    async with get_session() as s:
+        result = await s.stream(events.order_by(Event.id))
+        if fmt == "csv":
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(["id", "name", "start_time", "end_time", "city", "subjects"])
+        async for rows in result.partitions(EXPORT_CHUNK_SIZE):
+            res = await _event_dicts(s, rows)
+            if fmt == "csv":
+                for e in res:
+                    writer.writerow([
+                        e["id"], e["name"], e["start_time"], e["end_time"], e["city"],
+                        ";".join(i["name"] for i in e["subjects"]),
+                    ])
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+            else:
+                yield "".join(json.dumps(e) + "\n" for e in res)
+
+
+async def _event_dicts(session, rows):
+    """Serialize ``_EVENT_COLUMNS`` rows with city names and subjects filled in."""
+    res = [_serialize_event(e) for e in rows]
+    city_names = await city_cache.names(session, {e["city"] for e in res})
+    events_subjects = await _load_event_subjects(session, [e["id"] for e in res])
+    for e in res:
+        e["city"] = city_names[e["city"]]
+        e["subjects"] = events_subjects[e["id"]]
+    return res
+
+
+async def _group_subjects(session, ids, rows):
+    """Group (owner id, subject id) rows into {owner id: [subject]}, names from the reference cache."""
+    res = {i: [] for i in ids}
+    names = await subject_cache.names(session, {subject_id for owner_id, subject_id in rows})
+    for owner_id, subject_id in rows:
+        if names[subject_id] is not None:
+            res[owner_id].append({"id": subject_id, "name": names[subject_id]})
+    return res
+
+
+async def _load_event_subjects(session, event_ids):
+    """Load subjects of the given events with one query, grouped by event id."""
+    rows = []
+    if event_ids:
+        rows = (await session.execute(
+            select(EventSubject.event, EventSubject.subject)
+            .filter(EventSubject.event.in_(event_ids))
+            .order_by(EventSubject.event, EventSubject.subject)
+        )).fetchall()
+    return await _group_subjects(session, event_ids, rows)
+
+
+async def _load_filter_subjects(session, filter_ids):
+    """Load subjects of the given saved filters with one query, grouped by filter id."""
+    rows = []
+    if filter_ids:
+        rows = (await session.execute(
+            select(FilterSubject.filter, FilterSubject.subject)
+            .filter(FilterSubject.filter.in_(filter_ids))
+            .order_by(FilterSubject.filter, FilterSubject.subject)
+        )).fetchall()
+    return await _group_subjects(session, filter_ids, rows)
+
+
+async def _subject_list(session, subject_ids, refs=None):
+    """[{"id", "name"}] of ``subject_ids`` for a response written inside a write job.
+
+    Names come from the reference cache and ``refs``, the rest from the
+    job's session, so the cache only ever learns committed names.
+    """
+    names = {i: subject_cache.name(i) for i in subject_ids}
+    if refs is not None:
+        names.update((i, refs.by_id[i]) for i in names if i in refs.by_id)
+    missing = [i for i, name in names.items() if name is None]
+    if missing:
+        names.update((await session.execute(
+            select(Subject.id, Subject.name)
+            .filter(Subject.id.in_(missing))
+        )).fetchall())
+    return [{"id": i, "name": names[i]} for i in sorted(names) if names[i] is not None]
+
+
+async def _iter_lines(stream):
+    """Split a byte stream into lines without holding more than one line in memory.
+
+    Lines longer than BULK_MAX_LINE_SIZE are yielded as ``None``.
+    """
+    buf = b""
+    too_long = False
+    async for chunk in stream:
+        buf += chunk
+        start = 0
+        while True:
+            i = buf.find(b"\n", start)
+            if i < 0:
+                break
+            yield None if too_long or i - start > BULK_MAX_LINE_SIZE else buf[start:i]
+            start = i + 1
+            too_long = False
+        # trimmed once per chunk, slicing after every line is quadratic in the chunk size
+        buf = buf[start:]
+        if len(buf) > BULK_MAX_LINE_SIZE:
+            buf = b""
+            too_long = True
+    if buf or too_long:
+        yield None if too_long else buf
+
+
+def _parse_bulk_line(line):
+    if line is None:
+        return None, "line too long"
+    try:
+        event = EventRequest.parse_raw(line)
+    except ValidationError as e:
+        return None, "wrong event: {}".format(e.errors()[0]["msg"])
+    if event.id:
+        return None, "bulk only creates events"
+    if not event.name:
+        return None, "name is required"
+    try:
+        start_time = parse_datetime(event.start_time) if event.start_time else None
+        end_time = parse_datetime(event.end_time) if event.end_time else None
+    except ValueError:
+        return None, "wrong time format"
+    return (event, start_time, end_time), None
+
+
+async def _bulk_insert_events(chunk, user, results):
+    """Insert one chunk of parsed NDJSON lines through the write queue and write a result line for each of them."""
+    async def write(session):
+        parsed = [(line_no, item) for line_no, item, error in chunk if item is not None]
+        city_refs = await resolve_references(
+            session, City, [event.city for line_no, (event, start_time, end_time) in parsed if event.city]
+        )
+        subject_refs = await resolve_references(
+            session, Subject, [i for line_no, (event, start_time, end_time) in parsed for i in event.subjects or []]
+        )
+
+        errors = {line_no: error for line_no, item, error in chunk if error is not None}
+        events = []
+        for line_no, (event, start_time, end_time) in parsed:
+            city = city_refs.get(event.city) if event.city else None
+            if event.city and city is None:
+                errors[line_no] = "wrong city id"
+                continue
+            event_subjects = [subject_refs.get(i) for i in event.subjects or []]
+            if None in event_subjects:
+                errors[line_no] = "wrong subject id"
+                continue
+            events.append((
+                line_no,
+                {
+                    "user_id": user.id, "name": event.name, "start_time": start_time, "end_time": end_time,
+                    "city": city[0] if city else None,
+                },
+                dict(event_subjects),
+                city[1] if city else None,
+            ))
+        created = {}
+        if events:
+            rows = [row for line_no, row, event_subjects, city_name in events]
+            # multi-row inserts, each well under sqlite's bound parameter limit
+            batches = [Event.__table__.insert().values(rows[i:i + 150]) for i in range(0, len(rows), 150)]
+            if session.bind.dialect.full_returning:
+                ids = []
+                for insert in batches:
+                    ids += (await session.execute(insert.returning(Event.id))).scalars().all()
+            else:
+                # no RETURNING for sqlite here: the new rows are the ones past last_id, in
+                # insertion order, which only holds while this process' write queue is the
+                # database's single writer
+                last_id = (await session.execute(select(func.max(Event.id)))).scalar() or 0
+                for insert in batches:
+                    await session.execute(insert)
+                ids = (await session.execute(
+                    select(Event.id).filter(Event.id > last_id).order_by(Event.id)
+                )).scalars().all()
+            created = {line_no: event_id for (line_no, row, event_subjects, city_name), event_id in zip(events, ids)}
+            await add_event_subjects(
+                session,
+                [(event_id, subject_id) for (line_no, row, event_subjects, city_name), event_id in zip(events, ids)
+                 for subject_id in event_subjects],
+            )
+            for (line_no, row, event_subjects, city_name), event_id in zip(events, ids):
+                event = {
+                    "id": event_id, "name": row["name"],
+                    "start_time": row["start_time"].isoformat() if row["start_time"] else None,
+                    "end_time": row["end_time"].isoformat() if row["end_time"] else None,
+                    "city": city_name,
+                    "subjects": [{"id": i, "name": event_subjects[i]} for i in sorted(event_subjects)],
+                }
+                _notify_event(session, event, row["city"], row["start_time"], row["end_time"], event_subjects)
+        cities = {row["city"] for line_no, row, event_subjects, city_name in events}
+        subjects = {i for line_no, row, event_subjects, city_name in events for i in event_subjects}
+        if events:
+            _log_event_change(session, None, cities, subjects)
+        return created, errors, (cities, subjects), (city_refs, subject_refs)
+
+    created, errors, invalidate, (city_refs, subject_refs) = await write_queue.submit(write)
+    city_cache.remember(city_refs)
+    subject_cache.remember(subject_refs)
+    if created:
+        invalidate_events(*invalidate)
+
+    for line_no, item, error in chunk:
+        if line_no in created:
+            res = {"line": line_no, "id": created[line_no]}
+        else:
+            res = {"line": line_no, "error": errors[line_no]}
+        results.write(json.dumps(res).encode("utf-8") + b"\n")
+
+
+def _iter_file(f, chunk_size=64 * 1024):
+    try:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        f.close()
+
+
 @router.post(
     "/create",
     responses={
         200: {
             "model": EventResponse,
         },
+        400: {
+            "model": Error40xResponse,
+            "description": "wrong event, city or subject id",
+        },
         401: {
             "model": Error40xResponse,
             "description": "wrong auth token",
         },
+        403: {
+            "model": Error40xResponse,
+            "description": "event of another user",
+        },
     }
 )
 @check_auth
@@ -51,70 +463,134 @@ async def create_event(
         status_code: Optional[Any] = status.HTTP_200_OK,
         user_info: Optional[Any] = None,
 ) -> dict:
-    async with get_session() as s:
+    if not _valid_times(event.start_time, event.end_time):
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Error40xResponse.parse_obj({'reason': 'wrong time format'})
+
+    async def write(s):
+        if not event.id and not event.name:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            raise Rollback(Error40xResponse.parse_obj({'reason': 'name is required'}))
         city = None
-        if event.city:
-            city = await create_update_record(
-                session=s,
-                db_model=City,
-                fields=["name"],
-                request_model=event.city,
-                user=user_info,
-            )
+        city_refs = subject_refs = None
+        if event.city and event.city.id == -1:
+            city = (-1, None)
+        elif event.city:
+            city_refs = await resolve_references(s, City, [event.city])
+            city = city_refs.get(event.city)
             if not city:
                 response.status_code = status.HTTP_400_BAD_REQUEST
-                return Error40xResponse.parse_obj({'reason': 'wrong city id'})
+                raise Rollback(Error40xResponse.parse_obj({'reason': 'wrong city id'}))
         res_subjects = []
         if event.subjects:
-            for subject in event.subjects:
-                res_subjects.append(
-                    await create_update_record(
-                        session=s,
-                        db_model=Subject,
-                        fields=["name"],
-                        request_model=subject,
-                        user=user_info,
-                    )
-                )
-        event_res = await create_update_record(
-            session=s,
-            db_model=Event,
-            fields=["id", "name", "start_time", "end_time", "city"],
-            request_model=type(
-                "EventReq",
-                (BaseModel,),
-                {
-                    "id": event.id if event.id else 0,
-                    "name": event.name if event.name else -1,
-                    "start_time": event.start_time if event.start_time else -1,
-                    "end_time": event.end_time if event.end_time else -1,
-                    "city": city.id if city else -1,
-                }
-            )(),
-            editable=True,
-            user=user_info,
-        )
-        if res_subjects:
-            exist_recs = (await s.execute(
-                select(EventSubject.subject)
-                .filter(EventSubject.event == event_res.id))
-            ).fetchall()
-            add_recs = []
-            for subject in res_subjects:
-                if subject.id not in exist_recs:
-                    add_recs.append(
-                        EventSubject(
-                            event=event_res.id,
-                            subject=subject.id
-                        )
-                    )
-            s.add_all(add_recs)
-            await s.flush()
+            subject_refs = await resolve_references(s, Subject, event.subjects)
+            res_subjects = [subject_refs.get(i) for i in event.subjects]
+            if None in res_subjects:
+                response.status_code = status.HTTP_400_BAD_REQUEST
+                raise Rollback(Error40xResponse.parse_obj({'reason': 'wrong subject id'}))
+        old_city = None
+        if event.id:
+            old_city = (await s.execute(select(Event.city).filter(Event.id == event.id))).scalar()
+        try:
+            event_res = await create_update_record(
+                session=s,
+                db_model=Event,
+                fields=["id", "name", "start_time", "end_time", "city"],
+                request_model=EventWriteRequest.construct(
+                    id=event.id,
+                    name=event.name or None,
+                    start_time=event.start_time or None,
+                    end_time=event.end_time or None,
+                    city=city[0] if city else None,
+                ),
+                editable=True,
+                user=user_info,
+            )
+        except RequiredField as e:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            raise Rollback(Error40xResponse.parse_obj({'reason': str(e)}))
+        if event_res is None:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            raise Rollback(Error40xResponse.parse_obj({'reason': 'wrong event id'}))
+        if event_res is NOT_OWNED:
+            response.status_code = status.HTTP_403_FORBIDDEN
+            raise Rollback(Error40xResponse.parse_obj({'reason': 'not your event'}))
+        await add_event_subjects(s, {(event_res.id, subject_id) for subject_id, name in res_subjects})
+        subject_ids = set((await s.execute(
+            select(EventSubject.subject)
+            .filter(EventSubject.event == event_res.id))
+        ).scalars().all())
 
         res = event_res.as_dict()
-        res["city"] = city.name if city else None
-        await s.commit()
-        return EventResponse.parse_obj(res)
+        if city:
+            res["city"] = city[1]
+        elif event_res.city is not None:
+            # left out of an update, the event keeps its city
+            res["city"] = city_cache.name(event_res.city) or (await s.execute(
+                select(City.name).filter(City.id == event_res.city)
+            )).scalar()
+        res["subjects"] = await _subject_list(s, subject_ids, subject_refs)
+        res = EventResponse.parse_obj(res)
+        _notify_event(s, res.dict(), event_res.city, event_res.start_time, event_res.end_time, subject_ids)
+        invalidate = ({old_city, event_res.city}, subject_ids)
+        _log_event_change(s, event_res.id, *invalidate)
+        return res, invalidate, city_refs, subject_refs
+
+    res = await write_queue.submit(write)
+    if isinstance(res, Error40xResponse):
+        return res
+    res, invalidate, city_refs, subject_refs = res
+    if city_refs is not None:
+        city_cache.remember(city_refs)
+    if subject_refs is not None:
+        subject_cache.remember(subject_refs)
+    invalidate_events(*invalidate)
+    return res
+
+
+@router.post(
+    "/bulk",
+    responses={
+        200: {
+            "content": {"application/x-ndjson": {}},
+            "description": "one result line per input line",
+        },
+        401: {
+            "model": Error40xResponse,
+            "description": "wrong auth token",
+        },
+    }
+)
+@check_auth
+async def bulk_create_events(
+        response: Response,
+        request: Request,
+        authorization: Optional[str] = Header(None),
+        status_code: Optional[Any] = status.HTTP_200_OK,
+        user_info: Optional[Any] = None,
+) -> StreamingResponse:
+    """Create events from an NDJSON body, one ``EventRequest`` per line.
+
+    Lines are committed in chunks of BULK_CHUNK_SIZE, each created event
+    notified as by ``/create``; the response has one ``{"line": n, "id": ...}``
+    or ``{"line": n, "error": ...}`` line per input line.
+    """
+    results = tempfile.SpooledTemporaryFile(max_size=BULK_RESULTS_SPOOL_SIZE)
+    chunk = []
+    line_no = 0
+    async for line in _iter_lines(request.stream()):
+        line_no += 1
+        if line is not None and not line.strip():
+            continue
+        item, error = _parse_bulk_line(line)
+        chunk.append((line_no, item, error))
+        if len(chunk) >= BULK_CHUNK_SIZE:
+            await _bulk_insert_events(chunk, user_info, results)
+            chunk = []
+    if chunk:
+        await _bulk_insert_events(chunk, user_info, results)
+    results.seek(0)
+    return StreamingResponse(_iter_file(results), media_type="application/x-ndjson")
 
 
 @router.get(
@@ -140,38 +616,153 @@ async def get_events(
         start_time: Optional[str] = None,
         end_time: Optional[str] = None,
         subjects: Optional[str] = None,
+        time_match: Optional[str] = "exact",
         limit: Optional[int] = 20,
         offset: Optional[int] = 0,
+        cursor: Optional[str] = None,
+        if_none_match: Optional[str] = Header(None),
 ) -> List[dict]:
+    if time_match not in TIME_MATCHES:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Error40xResponse.parse_obj({'reason': 'wrong time_match'})
+    if not _valid_times(start_time, end_time):
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Error40xResponse.parse_obj({'reason': 'wrong time format'})
+    try:
+        last_id = decode_cursor(cursor) if cursor is not None else None
+    except ValueError as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Error40xResponse.parse_obj({'reason': str(e)})
+    key = (
+        city or None, start_time or None, end_time or None,
+        tuple(sorted(set(_parse_ids(subjects)))) if subjects else None,
+        limit, ("cursor", last_id) if last_id is not None else ("offset", offset), time_match,
+    )
+    cached = events_cache.get(key)
+    if cached is None:
+        generation = _events_cache_generation
+        async with get_session() as s:
+            events = _events_query(city, start_time, end_time, subjects, time_match)
+            etag = make_etag("events", key, (await s.execute(_events_watermark())).scalar())
+            if etag_matches(if_none_match, etag):
+                return not_modified(etag, response)
+            if last_id is not None:
+                events = events.filter(Event.id > last_id)
+            else:
+                events = events.offset(offset)
+            res = await _event_dicts(s, (await s.execute(events.order_by(Event.id).limit(limit))).all())
+        next_cursor = encode_cursor(res[-1]["id"]) if last_id is not None and limit and len(res) == limit else None
+        cached = (res, next_cursor, etag)
+        if generation == _events_cache_generation:
+            events_cache.set(key, cached, tags=_events_cache_tags(key[0], key[3]))
+    res, next_cursor, etag = cached
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag, response)
+    response.headers["ETag"] = etag
+    return list_response(res, response)
+
+
+@router.get(
+    "/search",
+    responses={
+        200: {
+            "model": List[EventResponse],
+            "decription": "events whose name matches the query, best matches first",
+        },
+        400: {
+            "model": Error40xResponse,
+            "description": "empty query",
+        },
+        401: {
+            "model": Error40xResponse,
+            "description": "wrong auth token",
+        },
+    }
+)
+@check_auth
+async def search_events(
+        response: Response,
+        authorization: Optional[str] = Header(None),
+        status_code=status.HTTP_200_OK,
+        user_info=None,
+        q: Optional[str] = "",
+        city: Optional[int] = None,
+        start_time: Optional[str] = None,
+        end_time: Optional[str] = None,
+        subjects: Optional[str] = None,
+        time_match: Optional[str] = "exact",
+        limit: Optional[int] = 20,
+        offset: Optional[int] = 0,
+) -> List[dict]:
+    """Search event names, best BM25 matches first; the last word of ``q`` matches as a prefix."""
+    match = _fts_match(q)
+    if match is None:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Error40xResponse.parse_obj({'reason': 'empty query'})
+    if time_match not in TIME_MATCHES:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Error40xResponse.parse_obj({'reason': 'wrong time_match'})
+    if not _valid_times(start_time, end_time):
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Error40xResponse.parse_obj({'reason': 'wrong time format'})
     async with get_session() as s:
-        subjects_qs = select(Subject, EventSubject).join(EventSubject, EventSubject.subject == Subject.id)
-        if subjects:
-            subjects_list = []
-            for i in subjects.split(','):
-                try:
-                    subjects_list.append(int(i))
-                except:
-                    pass
-            subjects_qs = subjects_qs.filter(Subject.id.in_(subjects_list))
-        subjects_qs = (await s.execute(subjects_qs)).fetchall()
-        if subjects:
-            events = select(Event, City, EventSubject).join(City, City.id == Event.city).join(EventSubject, (EventSubject.event == Event.id) & (EventSubject.subject.in_([i.id for i, j in subjects_qs])))
-        else:
-            events = select(Event, City, EventSubject).join(City, City.id == Event.city).join(EventSubject, EventSubject.event == Event.id)
-        if city:
-            events.filter(City.id == city)
-        if start_time:
-            events.filter(Event.start_time == dateutil.parser.parse(start_time))
-        if end_time:
-            events.filter(Event.end_time == dateutil.parser.parse(end_time))
-        events = (await s.execute(events.limit(limit).offset(offset))).fetchall()
-        res = []
-        for e, c, esub in events:
-            e = e.as_dict()
-            e["city"] = c.name if c else None
-            e["subjects"] = [{"id": subj.id, "name": subj.name} for subj, es in subjects_qs if e["id"] == es.event]
-            res.append(e)
-        return [EventResponse.parse_obj(e) for e in res]
+        events = (
+            _events_query(city, start_time, end_time, subjects, time_match)
+            .join(events_fts, events_fts.c.rowid == Event.id)
+            .filter(literal_column("events_fts").op("MATCH")(match))
+            .order_by(events_fts.c.rank, Event.id)
+            .offset(offset)
+            .limit(limit)
+        )
+        res = await _event_dicts(s, (await s.execute(events)).all())
+    return list_response(res, response)
+
+
+@router.get(
+    "/export",
+    responses={
+        200: {
+            "content": {"application/x-ndjson": {}, "text/csv": {}},
+            "description": "all events matching the filters",
+        },
+        400: {
+            "model": Error40xResponse,
+            "description": "unknown export format",
+        },
+        401: {
+            "model": Error40xResponse,
+            "description": "wrong auth token",
+        },
+    }
+)
+@check_auth
+async def export_events(
+        response: Response,
+        authorization: Optional[str] = Header(None),
+        status_code=status.HTTP_200_OK,
+        user_info=None,
+        city: Optional[int] = None,
+        start_time: Optional[str] = None,
+        end_time: Optional[str] = None,
+        subjects: Optional[str] = None,
+        time_match: Optional[str] = "exact",
+        format: Optional[str] = "ndjson",
+) -> StreamingResponse:
+    if format not in ("ndjson", "csv"):
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Error40xResponse.parse_obj({'reason': 'unknown format'})
+    if time_match not in TIME_MATCHES:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Error40xResponse.parse_obj({'reason': 'wrong time_match'})
+    if not _valid_times(start_time, end_time):
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Error40xResponse.parse_obj({'reason': 'wrong time format'})
+    return StreamingResponse(
+        _export_rows(_events_query(city, start_time, end_time, subjects, time_match), format),
+        media_type="text/csv" if format == "csv" else "application/x-ndjson",
+    )
 
 
 @router.post(
@@ -180,10 +771,18 @@ async def get_events(
         200: {
             "model": UserFilterResponse,
         },
+        400: {
+            "model": Error40xResponse,
+            "description": "wrong filter id",
+        },
         401: {
             "model": Error40xResponse,
             "description": "wrong auth token",
         },
+        403: {
+            "model": Error40xResponse,
+            "description": "filter of another user",
+        },
     }
 )
 @check_auth
@@ -195,7 +794,11 @@ async def create_event(
         status_code: Optional[Any] = status.HTTP_200_OK,
         user_info: Optional[Any] = None,
 ) -> dict:
-    async with get_session() as s:
+    if not _valid_times(filters.start_time, filters.end_time):
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Error40xResponse.parse_obj({'reason': 'wrong time format'})
+
+    async def write(s):
         filter = await create_update_record(
             session=s,
             db_model=UserFilter,
@@ -203,8 +806,14 @@ async def create_event(
             request_model=filters,
             user=user_info,
         )
+        if filter is None:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            raise Rollback(Error40xResponse.parse_obj({'reason': 'wrong filter id'}))
+        if filter is NOT_OWNED:
+            response.status_code = status.HTTP_403_FORBIDDEN
+            raise Rollback(Error40xResponse.parse_obj({'reason': 'not your filter'}))
         filter_subjects = []
-        for i in filters.subjects:
+        for i in filters.subjects or []:
             filter_subjects.append(
                 FilterSubject(
                     filter=filter.id,
@@ -213,19 +822,18 @@ async def create_event(
             )
         s.add_all(filter_subjects)
         await s.flush()
-        subjects = (await s.execute(
-            select(Subject)
-            .filter(Subject.id.in_(filters.subjects))
-        )).scalars().all()
-        res = {
-            "id": filter.id,
-            "start_time": filter.start_time,
-            "end_time": filter.end_time,
-            "city": filter.city,
-            "subjects": [{"id": i.id, "name": i.name} for i in subjects],
-        }
-        await s.commit()
-        return UserFilterResponse.parse_obj(res)
+        res = filter.as_dict()
+        res["subjects"] = await _subject_list(s, filters.subjects or [])
+        saved = (filter.id, filter.user_id, filter.city, filter.start_time, filter.end_time, filters.subjects or [])
+        log_change(s, "filter", filter.id)
+        return UserFilterResponse.parse_obj(res), saved
+
+    res = await write_queue.submit(write)
+    if isinstance(res, Error40xResponse):
+        return res
+    res, saved = res
+    filter_index.add(*saved)
+    return res
 
 
 @router.get(
@@ -249,26 +857,38 @@ async def get_events(
         user_info=None,
         limit: Optional[int] = 20,
         offset: Optional[int] = 0,
+        cursor: Optional[str] = None,
+        if_none_match: Optional[str] = Header(None),
 ) -> List[dict]:
+    try:
+        last_id = decode_cursor(cursor) if cursor is not None else None
+    except ValueError as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Error40xResponse.parse_obj({'reason': str(e)})
     async with get_session() as s:
-        filters = (await s.execute(
-            select(UserFilter)
-            .filter(UserFilter.user_id == user_info.id)
-        )).scalars().all()
-        res = []
-        for f in filters:
-            subjects = (await s.execute(
-                select(Subject, FilterSubject)
-                .join(FilterSubject, Subject.id == FilterSubject.subject)
-                .filter(FilterSubject.filter == f.id)
-            )).scalars().all()
-            res.append(
-                {
-                    "id": f.id,
-                    "start_time": f.start_time,
-                    "end_time": f.end_time,
-                    "city": f.city,
-                    "subjects": [{"id": i.id, "name": i.name} for i in subjects],
-                }
+        watermark = (await s.execute(
+            select(
+                func.count(UserFilter.id), func.max(UserFilter.id), func.max(UserFilter.updated_at),
+                select(func.max(FilterSubject.id))
+                .join(UserFilter, UserFilter.id == FilterSubject.filter)
+                .filter(UserFilter.user_id == user_info.id)
+                .scalar_subquery(),
             )
-        return [UserFilterResponse.parse_obj(r) for r in res]
+            .filter(UserFilter.user_id == user_info.id)
+        )).one()
+        etag = make_etag("filters", user_info.id, limit, offset, last_id, *watermark)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag, response)
+        response.headers["ETag"] = etag
+        filters = select(*_FILTER_COLUMNS).filter(UserFilter.user_id == user_info.id)
+        if last_id is not None:
+            filters = filters.filter(UserFilter.id > last_id)
+        else:
+            filters = filters.offset(offset)
+        res = [_serialize_filter(f) for f in (await s.execute(filters.order_by(UserFilter.id).limit(limit))).all()]
+        if last_id is not None and limit and len(res) == limit:
+            response.headers["X-Next-Cursor"] = encode_cursor(res[-1]["id"])
+        filters_subjects = await _load_filter_subjects(s, [f["id"] for f in res])
+        for f in res:
+            f["subjects"] = filters_subjects[f["id"]]
+        return list_response(res, response)
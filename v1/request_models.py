@@ -38,6 +38,14 @@ class EventRequest(BaseModel):
     subjects: Optional[List[SubjectRequest]]
 
 
+class EventWriteRequest(BaseModel):
+    id: Optional[int]
+    name: Optional[str]
+    start_time: Optional[str]
+    end_time: Optional[str]
+    city: Optional[int]
+
+
 class FilterRequest(BaseModel):
     id: Optional[int]
     start_time: Optional[str]
@@ -14,7 +14,7 @@ class AuthResponse(BaseModel):
 
 class AccountInfo(BaseModel):
     id: int
-    type: str
+    type: Optional[str]
     username: str
     created_at: datetime.datetime
     updated_at: datetime.datetime
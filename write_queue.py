@@ -0,0 +1,113 @@
+# coding: utf-8
+
+import asyncio
+
+from settings import WRITE_QUEUE_SIZE, WRITE_BATCH_SIZE
+
+from models.session import get_session
+from metrics import request_queries, count_queries
+
+
+class Rollback(Exception):
+    """Raised by a write job to discard its changes and still hand ``result`` to the caller."""
+
+    def __init__(self, result):
+        super().__init__(result)
+        self.result = result
+
+
+class WriteQueue:
+    """Funnels write transactions through the single "writer" connection.
+
+    ``submit`` queues an ``async def job(session)`` and waits for it. The
+    worker takes up to ``batch_size`` queued jobs, runs each in its own
+    SAVEPOINT and commits them together, so a failing job only loses its
+    own changes and concurrent writers share one commit instead of fighting
+    over the database lock. Results are handed back after the commit.
+    Statements of a job count towards the request that submitted it.
+
+    Until ``start`` is called jobs run directly, one transaction each, on
+    the default pool.
+    """
+
+    def __init__(self, maxsize=WRITE_QUEUE_SIZE, batch_size=WRITE_BATCH_SIZE):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.queue = None
+        self.worker = None
+        self.commits = 0
+        self.jobs = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue(self.maxsize)
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Finish the queued jobs and stop the worker."""
+        if self.worker is None:
+            return
+        await self.queue.join()
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.queue = self.worker = None
+
+    async def submit(self, job):
+        if self.worker is None:
+            async with get_session() as s:
+                try:
+                    res = await job(s)
+                except Rollback as e:
+                    return e.result
+                await s.commit()
+                return res
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((job, future, request_queries()))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self._commit(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _commit(self, batch):
+        done = []
+        try:
+            async with get_session("writer") as s:
+                for job, future, queries in batch:
+                    with count_queries(queries):
+                        savepoint = await s.begin_nested()
+                        try:
+                            res = await job(s)
+                        except Rollback as e:
+                            await savepoint.rollback()
+                            done.append((future, e.result))
+                        except Exception as e:
+                            await savepoint.rollback()
+                            if not future.done():
+                                future.set_exception(e)
+                        else:
+                            await savepoint.commit()
+                            done.append((future, res))
+                await s.commit()
+        except Exception as e:
+            for job, future, queries in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.commits += 1
+        self.jobs += len(batch)
+        for future, res in done:
+            if not future.done():
+                future.set_result(res)
+
+
+write_queue = WriteQueue()